@@ -2,23 +2,26 @@
 Defines Account class to create and manage accounts within a Pwfile instance in ezpass
 """
 
-import pyperclip
-
-from pwfile import PwFile
+from accountdb import AccountDB, AccountRecord
 from util import create_password
 
 
 class Account:
-    def __init__(self, pwfile: PwFile, org: str) -> None:
+    def __init__(self, pwfile, org: str) -> None:
         """
-        :param pwfile: PwFile instance
+        :param pwfile: PwFile instance, or AccountDB session to work against.
+        A bare PwFile gets its own session that writes every change through.
         :param org: name of organization that account belongs to (e.g. Bank of America)
         :param acname: account name (cannot contain spaces, newlines or tabs)
         """
         assert pwfile is not None
         if not Account.validate_orgname(org):
             raise RuntimeError("Org format is invalid")
-        self.pwfile = pwfile
+        if isinstance(pwfile, AccountDB):
+            self.db = pwfile
+        else:
+            self.db = AccountDB(pwfile, autoflush=True)
+        self.pwfile = self.db.pwfile
         self.org = org
         self.acname = None
         self.acpassword = None
@@ -61,11 +64,7 @@ class Account:
         """
         if not self.check_if_org_exists():
             raise RuntimeError("Account for org '{}' does not exist".format(self.org))
-        # read in the password file
-        data = self.pwfile.readFile()
-        # write out the password file except the account to delete
-        new_data = [account for account in data if account.org != self.org]
-        self.pwfile.writeFile(new_data)
+        self.db.remove(self.org)
         return
 
     def set_acpass_rand(self, alphabet: str, password_length: int) -> None:
@@ -100,23 +99,14 @@ class Account:
             raise RuntimeError("Account for org '{}' does not exist".format(self.org))
         if not Account.validate_pass(new_password):
             raise RuntimeError("Invalid password format")
-        # read in the password file
-        aclist = self.pwfile.readFile()
-        for account in aclist:
-            if account.org == self.org:
-                account.acpassword = new_password
-        self.pwfile.writeFile(aclist)
+        self.db.set_password(self.org, new_password)
         return
 
     def check_if_org_exists(self) -> bool:
         """
         If account exists in file, returns True. If account doesn't exist in file, returns False.
         """
-        aclist = self.pwfile.readFile()
-        for account in aclist:
-            if account.org == self.org:
-                return True
-        return False
+        return self.db.has(self.org)
 
     def get_password_from_file(self, print_to_screen: bool) -> None:
         """
@@ -126,36 +116,54 @@ class Account:
         :return: None
         :side effect: password in paste buffer (default) or printed to screen (if optional parameter used)
         """
-        aclist = self.pwfile.readFile()
-        for account in aclist:
-            if account.org == self.org:
-                username = account.acname
-                password = account.acpassword
-                print("Username for org '{}' is '{}'".format(self.org, username))
-                if print_to_screen:
-                    print("Password for org '{}' is '{}'".format(self.org, password))
-                else:
-                    pyperclip.copy(password)
-                return
-        raise RuntimeError("Account for org '{}' not in file".format(self.org))
-
-    def create_new_account(self, acname: str, alphabet: str, password_length: bool) -> None:
+        account = self.db.find(self.org)
+        if account is None:
+            raise RuntimeError("Account for org '{}' not in file".format(self.org))
+        Account.show_password(account, print_to_screen)
+        return
+
+    @staticmethod
+    def show_password(account, print_to_screen: bool) -> None:
+        """
+        Prints the username of account and puts its password in the paste
+        buffer (or prints it)
+        :param account: AccountRecord instance
+        :param print_to_screen: whether or not to print the password instead
+        :return: None
+        """
+        # pyperclip is only loaded when the paste buffer is used
+        import pyperclip
+
+        print("Username for org '{}' is '{}'".format(account.org,
+                                                     account.acname))
+        if print_to_screen:
+            print("Password for org '{}' is '{}'".format(account.org,
+                                                         account.acpassword))
+        else:
+            pyperclip.copy(account.acpassword)
+        return
+
+    def create_new_account(self, acname: str, alphabet: str, password_length: bool,
+                           acpassword: str = None) -> None:
         """
         For an account name that does not already exist in the file, appends the account name and password to the file
         :acname: username
         :param alphabet: string of the full alphabet
         :param password_length: length of password - an integer > 0
+        :param acpassword: password to use instead of a random one
         :return: None
         :side effect: account name and password appended to existing file
         """
         assert (password_length > 0)
         if not Account.validate_accountname(acname):
             raise RuntimeError("Account name {} has an invalid format".format(acname))
+        if acpassword is not None and not Account.validate_pass(acpassword):
+            raise RuntimeError("Invalid password format")
         if self.check_if_org_exists():
             raise RuntimeError("Account for org '{}' already exists".format(self.org))
-        self.acpassword = create_password(alphabet, password_length)
+        if acpassword is None:
+            acpassword = create_password(alphabet, password_length)
+        self.acpassword = acpassword
         self.acname = acname
-        aclist = self.pwfile.readFile()
-        aclist.append(self)
-        self.pwfile.writeFile(aclist)
+        self.db.add(AccountRecord(self.org, self.acname, self.acpassword))
         return
@@ -0,0 +1,291 @@
+"""
+Defines AccountDB class, an in-memory session over the accounts in a PwFile
+"""
+import fnmatch
+
+from pwfile import PwFile
+from record import AccountRecord
+from search import OrgIndex
+from util import create_passwords
+
+
+class AccountDB:
+    '''
+    Holds the decoded account list of a PwFile in memory. The file is read
+    (and decrypted) once; lookups are served from memory and changes are only
+    written back to the file on flush().
+    Accounts are indexed by org, and by case-folded org for case-insensitive
+    lookups, so finding, adding and removing an account take constant time.
+    If another process wrote the file since it was read, flush() re-reads it
+    and applies this session's changes on top, so neither side's changes to
+    different accounts are lost. For an account both changed, the last
+    flush wins.
+    '''
+
+    def __init__(self, pwfile: PwFile, autoflush: bool = False,
+                 lazy: bool = False) -> None:
+        """
+        :param pwfile: PwFile instance
+        :param autoflush: if True, every change is written to the file
+        immediately (bool)
+        :param lazy: if True, the file is only read when first needed, and
+        find() on a file with an index (see PwFile.has_index) reads just the
+        one account (bool)
+        """
+        assert pwfile is not None
+        self.pwfile = pwfile
+        self.autoflush = autoflush
+        self.dirty = False
+        # changes since the last flush, for PwFile.appendJournal. A migrated
+        # file can't be patched through the journal and must be rewritten
+        self._pending = []
+        self._rewrite = False
+        # org -> account, in file order. None until the file is read
+        self._by_org = None
+        # case-folded org -> {org: None} (an ordered set of matching orgs)
+        self._by_folded = {}
+        # OrgIndex for search() and complete(), built on first use and
+        # dropped when an org is added or removed
+        self._search = None
+        if not lazy:
+            self._load()
+
+    def _load(self) -> None:
+        """
+        Reads the accounts from the file, unless that was already done
+        :return: None
+        """
+        if self._by_org is not None:
+            return
+        self._by_org = {}
+        data = self.pwfile.readFile()
+        # files written before AccountRecord existed hold Account instances
+        # (each pickled with its PwFile). Convert them and mark the session
+        # dirty so the next flush rewrites the file in the compact format.
+        # The same goes for any file in an older serialization format
+        migrated = self.pwfile.legacy_format
+        for account in data:
+            if not isinstance(account, AccountRecord):
+                account = AccountRecord(account.org, account.acname,
+                                        account.acpassword)
+                migrated = True
+            self._index(account)
+        self.dirty = self.dirty or migrated
+        self._rewrite = self._rewrite or migrated
+        return
+
+    @property
+    def accounts(self) -> list:
+        self._load()
+        return list(self._by_org.values())
+
+    def __iter__(self):
+        self._load()
+        return iter(self._by_org.values())
+
+    def __len__(self) -> int:
+        self._load()
+        return len(self._by_org)
+
+    def find(self, org: str, ignore_case: bool = False):
+        """
+        :param org: name of organization
+        :param ignore_case: if True and there is no exact match, return an
+        account whose org matches when case-folded
+        :return: account stored for org, or None if org is not in the file
+        """
+        if self._by_org is None:
+            if self.pwfile.has_index() and not ignore_case:
+                return self.pwfile.lookup(org)
+            self._load()
+        account = self._by_org.get(org)
+        if account is None and ignore_case:
+            matches = self._by_folded.get(org.casefold())
+            if matches:
+                account = self._by_org[next(iter(matches))]
+        return account
+
+    def has(self, org: str) -> bool:
+        if self._by_org is None:
+            return self.find(org) is not None
+        return org in self._by_org
+
+    def orgs(self) -> list:
+        self._load()
+        return list(self._by_org)
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """
+        Finds orgs by prefix, substring or approximate spelling, ignoring
+        case (see search.OrgIndex.search)
+        :param query: part or misspelling of an org name
+        :param limit: most matches to return; 0 or None for all
+        :return: list of search.Match, best first
+        """
+        return self._org_index().search(query, limit)
+
+    def complete(self, prefix: str) -> list:
+        """
+        :param prefix: start of an org name (any case)
+        :return: list of orgs starting with prefix, ignoring case,
+        alphabetically
+        """
+        return self._org_index().complete(prefix)
+
+    def select(self, patterns: list) -> tuple:
+        """
+        Resolves org names and glob patterns (e.g. 'aws-*') to the orgs
+        stored in the session
+        :param patterns: list of org names or glob patterns; None for all
+        orgs
+        :return: tuple of (list of matching orgs in file order, list of
+        patterns that matched nothing)
+        """
+        self._load()
+        if patterns is None:
+            return self.orgs(), []
+        selected = {}
+        missing = []
+        for pattern in patterns:
+            if any(c in pattern for c in '*?['):
+                matches = [org for org in self._by_org
+                           if fnmatch.fnmatchcase(org, pattern)]
+            else:
+                matches = [pattern] if pattern in self._by_org else []
+            if not matches:
+                missing.append(pattern)
+            for org in matches:
+                selected[org] = None
+        orgs = [org for org in self._by_org if org in selected]
+        return orgs, missing
+
+    def add(self, account) -> None:
+        """
+        Adds account to the session
+        Assumes account.org is not already in the session
+        :param account: AccountRecord instance
+        :return: None
+        """
+        self._load()
+        self._index(account)
+        self._changed(('put', account))
+        return
+
+    def set_password(self, org: str, new_password: str) -> None:
+        """
+        Sets the password of the account stored for org
+        Assumes org exists in the session
+        :return: None
+        """
+        self._load()
+        account = self._by_org[org]._replace(acpassword=new_password)
+        self._by_org[org] = account
+        self._changed(('put', account))
+        return
+
+    def rotate(self, orgs: list, alphabet: str, password_length: int) -> None:
+        """
+        Sets the passwords of all given orgs to new random passwords, as one
+        change to the session
+        Assumes all orgs exist in the session
+        :param orgs: list of orgs
+        :param alphabet: string of full alphabet
+        :param password_length: length of password - an integer > 0
+        :return: None
+        """
+        if not orgs:
+            return
+        self._load()
+        passwords = create_passwords(alphabet, password_length, len(orgs))
+        changes = []
+        for org, new_password in zip(orgs, passwords):
+            account = self._by_org[org]._replace(acpassword=new_password)
+            self._by_org[org] = account
+            changes.append(('put', account))
+        self._changed(*changes)
+        return
+
+    def remove(self, org: str) -> None:
+        """
+        Removes the account stored for org
+        Assumes org exists in the session
+        :return: None
+        """
+        self._load()
+        self._unindex(org)
+        self._changed(('del', org))
+        return
+
+    def flush(self) -> None:
+        """
+        Writes the session's accounts to the file if anything changed. If the
+        PwFile keeps a journal, only the changes are appended to it (until the
+        journal is full, when the whole file is rewritten)
+        :return: None
+        :side effect: updated file
+        """
+        if not self.dirty:
+            return
+        with self.pwfile.lock(exclusive=True):
+            if self.pwfile.is_stale():
+                self._merge()
+            if self.pwfile.journal and not self._rewrite and \
+                    not self.pwfile.journal_full():
+                self.pwfile.appendJournal(self._pending)
+            else:
+                self.pwfile.writeFile(self.accounts)
+        self._pending = []
+        self._rewrite = False
+        self.dirty = False
+        return
+
+    def _merge(self) -> None:
+        """
+        Re-reads the file, which another process has written since this
+        session read it, and applies the pending changes to it
+        :return: None
+        """
+        self._by_org = None
+        self._by_folded = {}
+        self._load()
+        for op, arg in self._pending:
+            if op == 'put':
+                self._index(arg)
+            elif arg in self._by_org:
+                self._unindex(arg)
+        return
+
+    def _org_index(self) -> OrgIndex:
+        if self._search is None:
+            if self._by_org is None and self.pwfile.has_index():
+                # the orgs are in the index; no need to decrypt the accounts
+                orgs = self.pwfile.orgs()
+            else:
+                self._load()
+                orgs = self._by_org
+            self._search = OrgIndex(orgs)
+        return self._search
+
+    def _index(self, account) -> None:
+        if account.org not in self._by_org:
+            self._search = None
+        self._by_org[account.org] = account
+        self._by_folded.setdefault(account.org.casefold(), {})[account.org] = None
+        return
+
+    def _unindex(self, org: str) -> None:
+        self._search = None
+        del self._by_org[org]
+        folded = org.casefold()
+        matches = self._by_folded[folded]
+        del matches[org]
+        if not matches:
+            del self._by_folded[folded]
+        return
+
+    def _changed(self, *changes) -> None:
+        self._pending.extend(changes)
+        self.dirty = True
+        if self.autoflush:
+            self.flush()
+        return
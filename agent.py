@@ -0,0 +1,317 @@
+"""
+ezpass agent: a background process that holds password files unlocked, so
+that repeated ezpass calls skip the password prompt, key derivation and file
+decode. Like ssh-agent, it is started once per login session:
+
+    eval $(python3 agent.py -t 900)
+
+which prints the EZPASS_AUTH_SOCK variable ezpass looks for. A file is added
+with `ezpass.py -f FILE --agent-add`; `ezpass.py -f FILE -g org` then asks the
+agent before prompting for a password. The agent forgets a file (wiping its
+key) once the lock timeout has passed since it was added, on
+`ezpass.py -f FILE --agent-lock`, and when it exits (`python3 agent.py -k`).
+
+The agent only answers lookups. Changes are still made by ezpass itself; the
+agent notices the file (or its journal) changed and reads it again, which
+needs no key derivation.
+
+Requests and replies are JSON objects, one per line, on a Unix domain socket
+in a directory only the owner can enter.
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from pwfile import PwFile
+from accountdb import AccountDB
+from record import AccountRecord
+
+SOCKET_ENV = "EZPASS_AUTH_SOCK"
+DEFAULT_TIMEOUT = 15 * 60
+# longest request line accepted (bytes)
+MAX_REQUEST = 1 << 16
+
+
+class NotUnlocked(RuntimeError):
+    '''
+    Raised by AgentClient when the agent doesn't hold the file asked for
+    '''
+
+
+class AgentServer:
+    '''
+    Serves lookups for the files it holds unlocked. Requests are handled one
+    at a time; each is small and answered from memory.
+    '''
+
+    def __init__(self, sock_path: str, timeout: float = DEFAULT_TIMEOUT) -> None:
+        """
+        :param sock_path: path of the Unix domain socket to listen on
+        :param timeout: seconds after which an added file is forgotten
+        """
+        self.sock_path = sock_path
+        self.timeout = timeout
+        # real path of file -> dict with the PwFile, its AccountDB session,
+        # the signature of the file when it was read & when it expires
+        self.files = {}
+        self.running = False
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(sock_path)
+        os.chmod(sock_path, 0o600)
+        self._sock.listen(16)
+
+    def serve(self) -> None:
+        """
+        Answers requests until a 'stop' request (or stop() is called)
+        :return: None
+        :side effect: socket removed on return
+        """
+        self.running = True
+        # wake up regularly to forget expired files
+        self._sock.settimeout(1.0)
+        try:
+            while self.running:
+                self._expire()
+                try:
+                    conn, addr = self._sock.accept()
+                except socket.timeout:
+                    continue
+                with conn:
+                    self._serve_connection(conn)
+        finally:
+            self.stop()
+        return
+
+    def stop(self) -> None:
+        """
+        Forgets all files and closes the socket
+        :return: None
+        """
+        self.running = False
+        for fname in list(self.files):
+            self._forget(fname)
+        self._sock.close()
+        if os.path.exists(self.sock_path):
+            os.remove(self.sock_path)
+        return
+
+    def _serve_connection(self, conn) -> None:
+        conn.settimeout(5.0)
+        with conn.makefile("rb") as reader, conn.makefile("wb") as writer:
+            while True:
+                try:
+                    line = reader.readline(MAX_REQUEST)
+                except socket.timeout:
+                    return
+                if not line:
+                    return
+                try:
+                    reply = self.handle(json.loads(line))
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e) or type(e).__name__}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                writer.flush()
+
+    def handle(self, request: dict) -> dict:
+        """
+        :param request: dict with an "op" of 'add', 'get', 'lock' or 'stop'
+        (see the _op_* methods for the other keys)
+        :return: reply (dict); "ok" is False and "error" set if it failed
+        """
+        op = getattr(self, "_op_" + str(request.get("op")), None)
+        if op is None:
+            raise RuntimeError("Unknown request '{}'".format(request.get("op")))
+        reply = op(request)
+        reply["ok"] = True
+        return reply
+
+    def _op_add(self, request: dict) -> dict:
+        """
+        Unlocks request["file"] with request["password"] ("encrypt" False
+        for an unencrypted file)
+        """
+        fname = request["file"]
+        self._forget(fname)
+        signature = _signature(fname)
+        pwfile = PwFile(fname, request.get("password"),
+                        request.get("encrypt", True))
+        self.files[fname] = {"pwfile": pwfile, "db": AccountDB(pwfile),
+                             "signature": signature,
+                             "expires": time.monotonic() + self.timeout}
+        return {}
+
+    def _op_get(self, request: dict) -> dict:
+        """
+        Looks up request["org"] in request["file"]
+        """
+        self._expire()
+        entry = self.files.get(request["file"])
+        if entry is None:
+            return {"locked": True}
+        signature = _signature(request["file"])
+        if signature != entry["signature"]:
+            # written since it was read; the key is kept, so this is cheap
+            entry["db"] = AccountDB(entry["pwfile"])
+            entry["signature"] = signature
+        account = entry["db"].find(request["org"])
+        return {"account": None if account is None else list(account)}
+
+    def _op_lock(self, request: dict) -> dict:
+        """
+        Forgets request["file"]
+        """
+        self._forget(request["file"])
+        return {}
+
+    def _op_stop(self, request: dict) -> dict:
+        self.running = False
+        return {}
+
+    def _forget(self, fname: str) -> None:
+        entry = self.files.pop(fname, None)
+        if entry is not None:
+            entry["pwfile"].zeroize()
+        return
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for fname, entry in list(self.files.items()):
+            if entry["expires"] <= now:
+                self._forget(fname)
+        return
+
+
+def _signature(fname: str) -> tuple:
+    """
+    :return: stat details of fname and its journal that change whenever
+    either is written
+    """
+    signature = []
+    for name in (fname, fname + ".journal"):
+        try:
+            st = os.stat(name)
+            signature.append((st.st_ino, st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+class AgentClient:
+    '''
+    Talks to the agent listening on sock_path
+    '''
+
+    def __init__(self, sock_path: str) -> None:
+        self.sock_path = sock_path
+
+    def request(self, **request) -> dict:
+        """
+        Sends one request to the agent
+        :return: reply (dict)
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5.0)
+            sock.connect(self.sock_path)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("rb") as reader:
+                reply = json.loads(reader.readline())
+        if not reply.get("ok"):
+            raise RuntimeError("Agent error: {}".format(reply.get("error")))
+        return reply
+
+    def add(self, fname: str, fpass: str, encrypt: bool) -> None:
+        """
+        Has the agent unlock fname
+        :return: None
+        """
+        self.request(op="add", file=os.path.realpath(fname), password=fpass,
+                     encrypt=encrypt)
+        return
+
+    def find(self, fname: str, org: str):
+        """
+        :return: AccountRecord stored for org in fname, or None if org is not
+        in the file. Raises NotUnlocked if the agent doesn't hold fname
+        """
+        reply = self.request(op="get", file=os.path.realpath(fname), org=org)
+        if reply.get("locked"):
+            raise NotUnlocked("File '{}' is not unlocked in the agent".format(
+                fname))
+        if reply["account"] is None:
+            return None
+        return AccountRecord._make(reply["account"])
+
+    def lock(self, fname: str) -> None:
+        """
+        Has the agent forget fname
+        :return: None
+        """
+        self.request(op="lock", file=os.path.realpath(fname))
+        return
+
+    def stop(self) -> None:
+        self.request(op="stop")
+        return
+
+
+def connect():
+    """
+    :return: AgentClient for the agent named by $EZPASS_AUTH_SOCK, or None if
+    it isn't set
+    """
+    sock_path = os.environ.get(SOCKET_ENV)
+    if not sock_path:
+        return None
+    return AgentClient(sock_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='ezpass agent. Prints the shell commands that point ezpass '
+                    'at it, e.g. eval $(python3 agent.py)')
+    parser.add_argument('-t', '--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='seconds after which an added file is forgotten '
+                             '(default: {})'.format(DEFAULT_TIMEOUT))
+    parser.add_argument('-d', '--foreground', action='store_true',
+                        help="don't fork into the background")
+    parser.add_argument('-k', '--kill', action='store_true',
+                        help='stop the agent named by ' + SOCKET_ENV)
+    args = parser.parse_args()
+
+    if args.kill:
+        client = connect()
+        if client is None:
+            raise SystemExit("{} is not set".format(SOCKET_ENV))
+        client.stop()
+        print("unset {};".format(SOCKET_ENV))
+        return
+
+    sock_dir = tempfile.mkdtemp(prefix="ezpass-")
+    sock_path = os.path.join(sock_dir, "agent.{}".format(os.getpid()))
+    server = AgentServer(sock_path, args.timeout)
+    if not args.foreground and os.fork() != 0:
+        print("{}={}; export {};".format(SOCKET_ENV, sock_path, SOCKET_ENV))
+        return
+    if not args.foreground:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+    else:
+        print("{}={}; export {};".format(SOCKET_ENV, sock_path, SOCKET_ENV))
+        sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve()
+    finally:
+        shutil.rmtree(sock_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
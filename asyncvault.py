@@ -0,0 +1,213 @@
+"""
+Defines AsyncVault class, an asyncio interface to a password file for
+services that run on an event loop.
+
+Opening a file (key derivation, reading and decrypting it) and writing it
+take from tens to hundreds of milliseconds, so they run on an executor
+instead of blocking the loop. The file is opened once: lookups made while it
+is being opened wait for that one load rather than starting their own, and
+are then served from memory. Changes are made one at a time under an
+asyncio.Lock, and written to the file (on the executor) under the same lock.
+Lookups and changes to the accounts in memory take microseconds and run on
+the loop itself.
+"""
+import asyncio
+
+from pwfile import PwFile
+from accountdb import AccountDB
+from account import Account
+from util import ALPHABET
+
+
+class AsyncVault:
+    '''
+    Async session over one PwFile. Like AccountDB (which it wraps), it reads
+    the file once; if another process writes the file meanwhile, the next
+    write merges both sides' changes (see AccountDB.flush).
+    '''
+
+    def __init__(self, fname: str, fpass: str, encrypt: bool,
+                 executor=None, autoflush: bool = True, **options) -> None:
+        """
+        :param fname: file name
+        :param fpass: file password (None if not encrypted)
+        :param encrypt: whether or not the file is encrypted (bool)
+        :param executor: concurrent.futures executor to open and write the
+        file on; None for the event loop's default executor
+        :param autoflush: if True, every change is written to the file before
+        the call returns; otherwise on flush() (bool)
+        :param options: other PwFile arguments (backup, journal, layout, ...)
+        """
+        self.fname = fname
+        self.autoflush = autoflush
+        self._fpass = fpass
+        self._encrypt = encrypt
+        self._options = options
+        self._executor = executor
+        # the load in progress or done (a future of the AccountDB), shared by
+        # everyone who needs the file while it is being opened
+        self._loading = None
+        # held while the session changes and while it is written
+        self._lock = asyncio.Lock()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _open(self) -> AccountDB:
+        pwfile = PwFile(self.fname, self._fpass, self._encrypt,
+                        **self._options)
+        # the password is only needed to open the file
+        self._fpass = None
+        return AccountDB(pwfile)
+
+    async def _db(self) -> AccountDB:
+        """
+        Opens the file on the executor, unless that was already done or is
+        in progress
+        :return: AccountDB session
+        """
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self._run(self._open))
+        try:
+            return await asyncio.shield(self._loading)
+        except Exception:
+            # e.g. a wrong password: let the next call try again
+            if self._loading.done() and self._loading.exception() is not None:
+                self._loading = None
+            raise
+
+    async def open(self) -> None:
+        """
+        Opens the file now rather than on first use
+        :return: None
+        """
+        await self._db()
+        return
+
+    async def find(self, org: str, ignore_case: bool = False):
+        """
+        :param org: name of organization
+        :param ignore_case: see AccountDB.find
+        :return: AccountRecord stored for org, or None if org is not in the
+        file
+        """
+        db = await self._db()
+        async with self._lock:
+            return db.find(org, ignore_case)
+
+    async def select(self, patterns: list) -> tuple:
+        """
+        :param patterns: list of org names or glob patterns; None for all
+        orgs
+        :return: tuple of (list of AccountRecord of the matching orgs, list
+        of patterns that matched nothing); see AccountDB.select
+        """
+        db = await self._db()
+        async with self._lock:
+            orgs, missing = db.select(patterns)
+            return [db.find(org) for org in orgs], missing
+
+    async def search(self, query: str, limit: int = 10) -> list:
+        """
+        :param query: part or misspelling of an org name
+        :param limit: most matches to return; 0 or None for all
+        :return: list of search.Match, best first (see AccountDB.search)
+        """
+        db = await self._db()
+        async with self._lock:
+            return db.search(query, limit)
+
+    async def create_account(self, org: str, acname: str,
+                             password: str = None,
+                             password_length: int = 8):
+        """
+        Adds an account for org, which must not be in the file yet
+        :param org: name of organization
+        :param acname: username
+        :param password: password to set; None for a random one
+        :param password_length: length of a random password
+        :return: the new AccountRecord
+        :side effect: updated file (with autoflush)
+        """
+        if password_length < 1:
+            raise RuntimeError("Error. Password length must be greater than 0.")
+
+        def change(db):
+            # checks the password before adding the account
+            Account(db, org).create_new_account(acname, ALPHABET,
+                                                password_length, password)
+
+        return await self._change(org, change)
+
+    async def set_password(self, org: str, password: str = None,
+                           password_length: int = 8):
+        """
+        Changes the password of org's account
+        :param org: name of organization
+        :param password: new password; None for a random one
+        :param password_length: length of a random password
+        :return: the changed AccountRecord
+        :side effect: updated file (with autoflush)
+        """
+        if password_length < 1:
+            raise RuntimeError("Error. Password length must be greater than 0.")
+
+        def change(db):
+            account = Account(db, org)
+            if password is None:
+                account.set_acpass_rand(ALPHABET, password_length)
+            else:
+                account.set_acpass(password)
+
+        return await self._change(org, change)
+
+    async def delete_account(self, org: str) -> None:
+        """
+        Deletes org's account
+        :param org: name of organization
+        :return: None
+        :side effect: updated file (with autoflush)
+        """
+        await self._change(org, lambda db: Account(db, org).delete_account())
+        return
+
+    async def _change(self, org: str, change):
+        """
+        Applies change (a function of the AccountDB, which must check its
+        arguments before changing anything) under the lock and, with
+        autoflush, writes the file before releasing it
+        :return: AccountRecord stored for org afterwards, or None
+        """
+        db = await self._db()
+        async with self._lock:
+            change(db)
+            if self.autoflush:
+                await self._run(db.flush)
+            return db.find(org)
+
+    async def flush(self) -> None:
+        """
+        Writes the changes made since the last write to the file
+        :return: None
+        :side effect: updated file
+        """
+        if self._loading is None:
+            return
+        db = await self._db()
+        async with self._lock:
+            await self._run(db.flush)
+        return
+
+    async def close(self) -> None:
+        """
+        Writes any changes and clears the key from memory. The vault can't be
+        used afterwards
+        :return: None
+        """
+        if self._loading is None:
+            return
+        await self.flush()
+        db = await self._db()
+        db.pwfile.zeroize()
+        return
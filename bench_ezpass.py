@@ -0,0 +1,910 @@
+"""
+Benchmarks for ezpass. Run one of the benchmarks listed by:
+    python3 bench_ezpass.py -h
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import pickle
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import pwfile
+import stats
+from util import ALPHABET, create_password, create_passwords
+from pwfile import PwFile, LAYOUTS
+from accountdb import AccountDB
+from account import Account
+from agent import SOCKET_ENV, AgentClient, AgentServer
+from ezpass import get_many
+from record import AccountRecord
+from search import OrgIndex
+from vaults import unlock
+from serializer import SERIALIZERS, PickleSerializer, loads
+
+FILE_PASSWORD = "bench"
+# version of the layout of the suite's JSON results
+RESULTS_VERSION = 1
+# changes smaller than these are noise, however large a share of a tiny
+# baseline they are (see compare_results)
+COMPARE_FLOORS = {"seconds": 0.001, "peak_kb": 64}
+# most time 'import ezpass' may take (cumulative, best of --repeat runs) in ms
+IMPORT_BUDGET_MS = 75
+
+
+def _timed(func):
+    """
+    Runs func once
+    :return: tuple of (seconds taken, PwFile.kdf_count delta)
+    """
+    kdf_before = PwFile.kdf_count
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    return elapsed, PwFile.kdf_count - kdf_before
+
+
+def _report(name, elapsed, kdf):
+    print("{:<24} {:>10.2f} ms {:>6} key derivations".format(
+        name, elapsed * 1000, kdf))
+
+
+def bench_kdf(args):
+    """
+    Reports the number of key derivations each ezpass operation costs
+    """
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, "vault")
+    elapsed, kdf = _timed(
+        lambda: PwFile.create_new_file(fname, FILE_PASSWORD, True))
+    _report("create file", elapsed, kdf)
+
+    holder = {}
+    elapsed, kdf = _timed(
+        lambda: holder.update(pwfile=PwFile(fname, FILE_PASSWORD, True)))
+    _report("open file", elapsed, kdf)
+    pwfile = holder["pwfile"]
+
+    def create():
+        for i in range(args.accounts):
+            Account(pwfile, "org{}".format(i)).create_new_account(
+                "user", ALPHABET, 8)
+    elapsed, kdf = _timed(create)
+    _report("create account (each)", elapsed / args.accounts,
+            kdf / args.accounts)
+
+    account = Account(pwfile, "org0")
+    elapsed, kdf = _timed(account.check_if_org_exists)
+    _report("lookup", elapsed, kdf)
+    elapsed, kdf = _timed(lambda: account.set_acpass("n3wpass"))
+    _report("change password", elapsed, kdf)
+    elapsed, kdf = _timed(account.delete_account)
+    _report("delete account", elapsed, kdf)
+
+    shutil.rmtree(tmpdir)
+
+
+def _populate(fname, count, encrypt):
+    """
+    Creates file fname holding count accounts named org0 .. org<count-1>
+    :return: PwFile instance for the new file
+    """
+    pwfile = PwFile.create_new_file(fname, FILE_PASSWORD, encrypt)
+    db = AccountDB(pwfile)
+    for i in range(count):
+        Account(db, "org{}".format(i)).create_new_account("user", ALPHABET, 8)
+    db.flush()
+    return pwfile
+
+
+def bench_index(args):
+    """
+    Times org lookups and deletes on AccountDB against a linear scan of the
+    account list, for growing numbers of accounts
+    """
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, "vault")
+    print("{:>8} {:>14} {:>14} {:>14}".format(
+        "accounts", "scan (us)", "find (us)", "remove (us)"))
+    for count in args.sizes:
+        db = AccountDB(_populate(fname, count, False))
+        accounts = db.accounts
+        orgs = ["org{}".format(i) for i in range(0, count, max(1, count // 100))]
+
+        start = time.perf_counter()
+        for org in orgs:
+            next(account for account in accounts if account.org == org)
+        scan = (time.perf_counter() - start) / len(orgs)
+
+        start = time.perf_counter()
+        for org in orgs:
+            db.find(org)
+        find = (time.perf_counter() - start) / len(orgs)
+
+        start = time.perf_counter()
+        for org in orgs:
+            db.remove(org)
+        remove = (time.perf_counter() - start) / len(orgs)
+
+        print("{:>8} {:>14.2f} {:>14.2f} {:>14.2f}".format(
+            count, scan * 1e6, find * 1e6, remove * 1e6))
+        os.remove(fname)
+    shutil.rmtree(tmpdir)
+
+
+def _legacy_account(fname, org):
+    """
+    :return: Account laid out as files stored it before AccountRecord
+    """
+    pwfile = PwFile.__new__(PwFile)
+    pwfile.__dict__.update(fname=fname, fpass=FILE_PASSWORD, encrypt=True)
+    account = Account.__new__(Account)
+    account.__dict__.update(pwfile=pwfile, org=org, acname="user",
+                            acpassword="password")
+    return account
+
+
+def bench_record(args):
+    """
+    Compares file size and load time of legacy Account pickles against
+    AccountRecord lists
+    """
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, "vault")
+    PwFile.create_new_file(fname, FILE_PASSWORD, True)
+    pwfile = PwFile(fname, FILE_PASSWORD, True, serializer=PickleSerializer)
+    orgs = ["org{}".format(i) for i in range(args.accounts)]
+    layouts = [
+        ("Account (legacy)", [_legacy_account(fname, org) for org in orgs]),
+        ("AccountRecord",
+         [AccountRecord(org, "user", "password") for org in orgs]),
+    ]
+    print("{:<18} {:>14} {:>12}".format("layout", "bytes/account", "load (ms)"))
+    for name, data in layouts:
+        pwfile.writeFile(data)
+        size = os.path.getsize(fname)
+        payload = pickle.dumps(data)
+        start = time.perf_counter()
+        pickle.loads(payload)
+        load = time.perf_counter() - start
+        print("{:<18} {:>14.1f} {:>12.2f}".format(
+            name, size / args.accounts, load * 1000))
+    shutil.rmtree(tmpdir)
+
+
+def bench_serializer(args):
+    """
+    Compares save time, load time and size of each serializer
+    """
+    print("{:>8} {:<8} {:>10} {:>10} {:>12}".format(
+        "accounts", "format", "save (ms)", "load (ms)", "bytes"))
+    for count in args.sizes:
+        data = [AccountRecord("org{}".format(i), "user{}@example.com".format(i),
+                              "password{}".format(i)) for i in range(count)]
+        for name, serializer in SERIALIZERS.items():
+            start = time.perf_counter()
+            payload = serializer.dumps(data)
+            save = time.perf_counter() - start
+            start = time.perf_counter()
+            serializer.loads(payload)
+            load = time.perf_counter() - start
+            print("{:>8} {:<8} {:>10.2f} {:>10.2f} {:>12}".format(
+                count, name, save * 1000, load * 1000, len(payload)))
+
+
+def _legacy_create_password(alphabet, length):
+    """
+    create_password as it was before create_passwords existed
+    """
+    password = ""
+    for i in range(length):
+        letter = alphabet[random.randint(0, len(alphabet) - 1)]
+        password = password + letter
+    return password
+
+
+def bench_password(args):
+    """
+    Times generating many passwords with the legacy per-letter generator,
+    create_password and the batch create_passwords
+    """
+    alphabet = ALPHABET + ALPHABET.upper() + "0123456789"
+    runs = [
+        ("legacy per-letter", lambda: [
+            _legacy_create_password(alphabet, args.length)
+            for i in range(args.count)]),
+        ("create_password", lambda: [
+            create_password(alphabet, args.length)
+            for i in range(args.count)]),
+        ("create_passwords", lambda: create_passwords(
+            alphabet, args.length, args.count)),
+    ]
+    print("{} passwords of length {}".format(args.count, args.length))
+    for name, func in runs:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        print("{:<20} {:>10.2f} ms".format(name, elapsed * 1000))
+
+
+def bench_journal(args):
+    """
+    Compares the time and bytes written for a single password change with a
+    full rewrite against an append to the journal
+    """
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, "vault")
+    _populate(fname, args.accounts, True)
+    print("{} accounts, encrypted".format(args.accounts))
+    print("{:<14} {:>12} {:>16}".format("write", "time (ms)", "bytes written"))
+    for name, journal in [("full rewrite", False), ("journal", True)]:
+        db = AccountDB(PwFile(fname, FILE_PASSWORD, True, journal=journal))
+        journal_fname = db.pwfile.get_journal_fname()
+        db.set_password("org0", "n3wpass")
+        start = time.perf_counter()
+        db.flush()
+        elapsed = time.perf_counter() - start
+        if journal:
+            written = os.path.getsize(journal_fname)
+            os.remove(journal_fname)
+        else:
+            written = os.path.getsize(fname)
+        print("{:<14} {:>12.2f} {:>16}".format(name, elapsed * 1000, written))
+    shutil.rmtree(tmpdir)
+
+
+def bench_lookup(args):
+    """
+    Times looking up one account after opening the file, for the 'single'
+    and 'indexed' layouts
+    """
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, "vault")
+    pwfile = _populate(fname, args.accounts, True)
+    print("{} accounts, encrypted".format(args.accounts))
+    print("{:<8} {:>12} {:>12} {:>12}".format(
+        "layout", "file bytes", "open (ms)", "lookup (ms)"))
+    for layout in LAYOUTS:
+        pwfile.layout = layout
+        pwfile.writeFile(AccountDB(pwfile).accounts)
+        start = time.perf_counter()
+        db = AccountDB(PwFile(fname, FILE_PASSWORD, True), lazy=True)
+        opened = time.perf_counter()
+        db.find("org{}".format(args.accounts // 2))
+        done = time.perf_counter()
+        print("{:<8} {:>12} {:>12.2f} {:>12.2f}".format(
+            layout, os.path.getsize(fname), (opened - start) * 1000,
+            (done - opened) * 1000))
+    shutil.rmtree(tmpdir)
+
+
+def _legacy_read(fname):
+    """
+    Reads an encrypted 'single' layout file the way PwFile did before it
+    read files through a memory map: as text, re-encoded to bytes
+    :return: list of AccountRecord instances
+    """
+    header = PwFile._readHeader(fname)
+    key = PwFile._derive_key(FILE_PASSWORD, header["kdf"])
+    with open(fname, "r") as enc_file:
+        cipher_text = enc_file.read()
+    enc_cipher_text = cipher_text.encode()
+    enc_cipher_text = enc_cipher_text[header["size"]:]
+    return loads(PwFile._fernet(key).decrypt(enc_cipher_text))
+
+
+# ru_maxrss is inherited from the parent process, so the child resets its
+# peak RSS through /proc (Linux only) and reads it back from there
+_RSS_CHILD = """
+import sys
+from bench_ezpass import FILE_PASSWORD, _legacy_read
+from pwfile import PwFile
+def status(field):
+    with open("/proc/self/status") as status_file:
+        for line in status_file:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+fname = sys.argv[1]
+with open("/proc/self/clear_refs", "w") as clear_refs:
+    clear_refs.write("5")
+before = status("VmRSS")
+data = {}
+print(status("VmHWM") - before)
+"""
+
+
+def _open_peak_rss(statement, fname):
+    """
+    Runs statement in a new interpreter (with fname bound to the file name)
+    :return: growth of peak RSS (KB) while it ran
+    """
+    output = subprocess.check_output(
+        [sys.executable, "-c", _RSS_CHILD.format(statement), fname],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    return int(output)
+
+
+def bench_rss(args):
+    """
+    Measures the peak memory used to open and decode a large encrypted file
+    with the old (read as text, then copy) and the memory-mapped read path
+    """
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, "vault")
+    pwfile = _populate(fname, args.accounts, True)
+    accounts = AccountDB(pwfile).accounts
+    plaintext = len(pwfile.serializer.dumps(accounts))
+    # memory taken by the decoded accounts themselves
+    decoded = sys.getsizeof(accounts) + sum(
+        sys.getsizeof(account) + sum(map(sys.getsizeof, account))
+        for account in accounts)
+    print("{} accounts, encrypted: {} KB on disk, {} KB of plaintext, {} KB "
+          "of decoded accounts".format(
+              args.accounts, os.path.getsize(fname) // 1024,
+              plaintext // 1024, decoded // 1024))
+    print("{:<12} {:>10} {:>26}".format(
+        "read path", "peak (KB)", "peak - decoded accounts"))
+    runs = [
+        ("text (old)", "_legacy_read(fname)"),
+        ("mmap", "PwFile(fname, FILE_PASSWORD, True).readFile()"),
+    ]
+    for name, statement in runs:
+        peak = _open_peak_rss(statement, fname)
+        print("{:<12} {:>10} {:>26}".format(
+            name, peak, peak - decoded // 1024))
+    shutil.rmtree(tmpdir)
+
+
+def bench_agent(args):
+    """
+    Compares the time to fetch one password per call with and without an
+    agent holding the file unlocked, in-process and through the ezpass CLI
+    """
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, "vault")
+    _populate(fname, args.accounts, True)
+    org = "org{}".format(args.accounts // 2)
+    server = AgentServer(os.path.join(tmpdir, "agent"))
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    client = AgentClient(server.sock_path)
+    client.add(fname, FILE_PASSWORD, True)
+
+    def cli(env):
+        # a new session has no controlling terminal, so getpass reads the
+        # file password from stdin
+        subprocess.run(
+            [sys.executable, "ezpass.py", "-f", fname, "-g", org, "-print"],
+            input=(FILE_PASSWORD + "\n").encode(), env=env,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            start_new_session=True, capture_output=True, check=True)
+
+    no_agent_env = {k: v for k, v in os.environ.items() if k != SOCKET_ENV}
+    agent_env = dict(no_agent_env, **{SOCKET_ENV: server.sock_path})
+    runs = [
+        ("unlock + find", lambda: AccountDB(
+            PwFile(fname, FILE_PASSWORD, True), lazy=True).find(org)),
+        ("agent find", lambda: client.find(fname, org)),
+        ("CLI -g, no agent", lambda: cli(no_agent_env)),
+        ("CLI -g, agent", lambda: cli(agent_env)),
+    ]
+    print("{} accounts, encrypted, {} calls each".format(args.accounts,
+                                                      args.calls))
+    print("{:<18} {:>14}".format("lookup", "per call (ms)"))
+    for name, func in runs:
+        start = time.perf_counter()
+        for i in range(args.calls):
+            func()
+        elapsed = (time.perf_counter() - start) / args.calls
+        print("{:<18} {:>14.2f}".format(name, elapsed * 1000))
+    client.stop()
+    thread.join()
+    shutil.rmtree(tmpdir)
+
+
+def bench_vaults(args):
+    """
+    Compares unlocking several files one after another with unlocking them
+    in parallel (vaults.unlock)
+    """
+    tmpdir = tempfile.mkdtemp()
+    fnames = [os.path.join(tmpdir, "vault{}".format(i))
+              for i in range(args.vaults)]
+    for fname in fnames:
+        _populate(fname, args.accounts, True)
+    passwords = [FILE_PASSWORD] * len(fnames)
+    print("{} files of {} accounts, encrypted, {} CPU(s)".format(
+        args.vaults, args.accounts, len(os.sched_getaffinity(0))))
+    start = time.perf_counter()
+    PwFile(fnames[0], FILE_PASSWORD, True)
+    one = time.perf_counter() - start
+    start = time.perf_counter()
+    for fname in fnames:
+        PwFile(fname, FILE_PASSWORD, True)
+    sequential = time.perf_counter() - start
+    start = time.perf_counter()
+    unlock(fnames, passwords, True)
+    parallel = time.perf_counter() - start
+    print("{:<12} {:>10}".format("unlock", "time (ms)"))
+    for name, elapsed in [("one file", one), ("sequential", sequential),
+                          ("parallel", parallel)]:
+        print("{:<12} {:>10.1f}".format(name, elapsed * 1000))
+    shutil.rmtree(tmpdir)
+
+
+def bench_chunked(args):
+    """
+    Times encrypting and decrypting 'chunked' layout files of several sizes
+    with several numbers of threads (pwfile.CHUNK_WORKERS)
+    """
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, "chunked")
+    key = bytearray(os.urandom(32))
+    kdf = PwFile.new_kdf()
+    print("{} MB chunks, {} CPU(s)".format(pwfile.CHUNK_SIZE >> 20,
+                                           len(os.sched_getaffinity(0))))
+    print("{:>6} {:>7} {:>12} {:>12}".format(
+        "chunks", "threads", "encrypt (ms)", "decrypt (ms)"))
+    try:
+        for count in args.chunks:
+            payload = os.urandom(count * pwfile.CHUNK_SIZE)
+            for workers in args.workers:
+                pwfile.CHUNK_WORKERS = workers
+                start = time.perf_counter()
+                contents = PwFile._encryptChunked(fname, key, payload, kdf)
+                encrypt = time.perf_counter() - start
+                header = contents[0]
+                data = b"".join(contents)
+                del contents
+                start = time.perf_counter()
+                PwFile._decryptChunked(key, data, len(header),
+                                       pwfile.CHUNK_SIZE)
+                decrypt = time.perf_counter() - start
+                print("{:>6} {:>7} {:>12.1f} {:>12.1f}".format(
+                    count, workers, encrypt * 1000, decrypt * 1000))
+    finally:
+        pwfile.CHUNK_WORKERS = None
+        shutil.rmtree(tmpdir)
+
+
+def bench_import(args):
+    """
+    Times 'import ezpass' in a new interpreter (python -X importtime) and
+    lists the modules that take longest; exits with an error if it takes
+    longer than --budget
+    """
+    env = dict(os.environ)
+    # time imports from cached bytecode, as an installed ezpass would
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    subprocess.run([sys.executable, "-c", "import ezpass"], env=env,
+                   check=True)
+    best = None
+    for i in range(args.repeat):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import ezpass"],
+            env=env, capture_output=True, text=True, check=True)
+        times = {}
+        for line in result.stderr.splitlines()[1:]:
+            self_us, cumulative_us, module = line.split(":", 1)[1].split("|")
+            times[module.strip()] = (int(self_us), int(cumulative_us))
+        if best is None or times["ezpass"][1] < best["ezpass"][1]:
+            best = times
+    print("{:<24} {:>10} {:>16}".format("module", "self (ms)",
+                                        "cumulative (ms)"))
+    slowest = sorted(best.items(), key=lambda item: item[1][0], reverse=True)
+    for module, (self_us, cumulative_us) in slowest[:args.top]:
+        print("{:<24} {:>10.1f} {:>16.1f}".format(
+            module, self_us / 1000, cumulative_us / 1000))
+    total = best["ezpass"][1] / 1000
+    print("import ezpass: {:.1f} ms (budget {} ms)".format(total,
+                                                          args.budget))
+    if total > args.budget:
+        raise SystemExit("import ezpass is over budget")
+
+
+def bench_getmany(args):
+    """
+    Compares fetching the credentials of several orgs with one -g each
+    (opening and decrypting the file every time) with one multi-get
+    """
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, "vault")
+    _populate(fname, args.accounts, True)
+    print("{} accounts, encrypted".format(args.accounts))
+    print("{:<6} {:>14} {:>14}".format("orgs", "one -g (ms)", "multi-get (ms)"))
+    for count in args.orgs:
+        orgs = ["org{}".format(i) for i in range(count)]
+        start = time.perf_counter()
+        for org in orgs:
+            AccountDB(PwFile(fname, FILE_PASSWORD, True), lazy=True).find(org)
+        separate = time.perf_counter() - start
+        start = time.perf_counter()
+        get_many(AccountDB(PwFile(fname, FILE_PASSWORD, True), lazy=True),
+                 orgs, 'export', io.StringIO())
+        together = time.perf_counter() - start
+        print("{:<6} {:>14.1f} {:>14.1f}".format(count, separate * 1000,
+                                                together * 1000))
+    shutil.rmtree(tmpdir)
+
+
+def _org_names(count):
+    """
+    :return: list of count distinct org names like 'kotaru-prod-17'
+    """
+    rng = random.Random(0)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = ["".join(rng.choice(letters) for i in range(rng.randint(3, 8)))
+             for j in range(max(count // 50, 10))]
+    envs = ["prod", "staging", "dev", "test", "eu", "us"]
+    orgs = {}
+    while len(orgs) < count:
+        orgs["{}-{}-{}".format(rng.choice(words), rng.choice(envs),
+                               rng.randint(1, 99))] = None
+    return list(orgs)
+
+
+def bench_search(args):
+    """
+    Times search queries of each kind against an OrgIndex and against a
+    scan of all orgs, and org name completion
+    """
+    orgs = _org_names(args.orgs)
+    start = time.perf_counter()
+    index = OrgIndex(orgs)
+    built = time.perf_counter()
+    # the trigrams are indexed by the first substring or fuzzy search
+    index.search("abc")
+    print("{} orgs, index built in {:.0f} ms (+{:.0f} ms trigrams)".format(
+        len(orgs), (built - start) * 1000,
+        (time.perf_counter() - built) * 1000))
+    word = orgs[len(orgs) // 2].split("-")[0]
+    queries = [
+        ("exact", orgs[len(orgs) // 2]),
+        ("prefix", word[:3]),
+        ("substring", word[1:] + "-st"),
+        ("fuzzy", word[:2] + "x" + word[2:] + "-prod"),
+        ("no match", "zzqxj"),
+    ]
+    print("{:<10} {:<20} {:>8} {:>12} {:>12}".format(
+        "query", "", "matches", "index (ms)", "scan (ms)"))
+    for name, query in queries:
+        start = time.perf_counter()
+        for i in range(args.calls):
+            matches = index.search(query, args.limit)
+        indexed = (time.perf_counter() - start) / args.calls
+        folded = query.casefold()
+        start = time.perf_counter()
+        [org for org in orgs if folded in org.casefold()]
+        scanned = time.perf_counter() - start
+        print("{:<10} {:<20} {:>8} {:>12.3f} {:>12.3f}".format(
+            name, query, len(matches), indexed * 1000, scanned * 1000))
+    prefix = word[:2]
+    start = time.perf_counter()
+    for i in range(args.calls):
+        completions = index.complete(prefix)
+    elapsed = (time.perf_counter() - start) / args.calls
+    print("{:<10} {:<20} {:>8} {:>12.3f}".format(
+        "complete", prefix, len(completions), elapsed * 1000))
+
+
+def generate_vault(fname, count, encrypt, layout='single'):
+    """
+    Creates file fname holding count synthetic accounts named org0 ..
+    org<count-1>, written in one go (unlike _populate, which adds them one
+    at a time), so that vaults of a million accounts take seconds
+    :return: PwFile instance for the new file
+    """
+    pwfile = PwFile.create_new_file(fname, FILE_PASSWORD if encrypt else None,
+                                    encrypt, layout=layout)
+    if count:
+        passwords = create_passwords(ALPHABET, 16, count)
+        pwfile.writeFile([
+            AccountRecord("org{}".format(i), "user{}@example.com".format(i),
+                          password)
+            for i, password in enumerate(passwords)])
+    return pwfile
+
+
+# operations timed by the suite, each run as one ezpass command would:
+# create (a vault of all the accounts), unlock (key derivation alone, for
+# encrypted vaults), open (read the vault into a session), get (lazy lookup)
+# and add / change / delete (one account, then save)
+SUITE_OPS = ["create", "unlock", "open", "get", "add", "change", "delete"]
+
+
+def _suite_ops(fname, count, encrypt, layout):
+    """
+    :return: dict of operation -> function taking the repeat number (so
+    repeats of a change don't collide). delete removes the account add made
+    in the same repeat, so the vault keeps its size whatever the number of
+    repeats
+    """
+    password = FILE_PASSWORD if encrypt else None
+    org = "org{}".format(count // 2)
+
+    def session(lazy=False):
+        return AccountDB(PwFile(fname, password, encrypt), lazy=lazy)
+
+    def create(i):
+        new_fname = "{}.new{}".format(fname, i)
+        generate_vault(new_fname, count, encrypt, layout)
+        os.remove(new_fname)
+
+    def unlock(i):
+        PwFile._derive_key(password, PwFile._readHeader(fname)["kdf"])
+
+    def change(i):
+        db = session()
+        db.set_password(org, "changed{}".format(i))
+        db.flush()
+
+    def add(i):
+        db = session()
+        db.add(AccountRecord("new{}".format(i), "user", "password"))
+        db.flush()
+
+    def delete(i):
+        db = session()
+        db.remove("new{}".format(i))
+        db.flush()
+
+    ops = {"create": create, "open": lambda i: session(),
+           "get": lambda i: session(lazy=True).find(org),
+           "add": add, "change": change, "delete": delete}
+    if encrypt:
+        ops["unlock"] = unlock
+    return ops
+
+
+def _measure(func, repeat):
+    """
+    Runs func(i) for i in range(repeat) for time, and once more under
+    tracemalloc (which slows it down) for peak memory
+    :return: dict of "seconds" (fastest run), "peak_kb" (peak Python memory
+    allocated) and "bytes_written" (per run, from stats)
+    """
+    best = None
+    stats.enable()
+    stats.reset()
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(i)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    written = stats.snapshot()["operations"].get("write", {}).get("bytes", 0)
+    stats.enable(False)
+    stats.reset()
+    tracemalloc.start()
+    func(repeat)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"seconds": best, "peak_kb": peak // 1024,
+            "bytes_written": written // repeat}
+
+
+def bench_suite(args):
+    """
+    Times every ezpass operation on synthetic vaults of each size, plain
+    and encrypted, and optionally saves the results as JSON and compares
+    them with an earlier results file
+    """
+    if min(args.sizes) < 1 or args.repeat < 1:
+        raise SystemExit("Sizes and --repeat must be at least 1")
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, "vault")
+    results = []
+    print("{:<10} {:>8} {:<7} {:>10} {:>10} {:>14}".format(
+        "mode", "accounts", "op", "time (ms)", "peak (KB)", "bytes written"))
+    try:
+        for mode in args.modes:
+            encrypt = mode == 'encrypted'
+            for size in args.sizes:
+                generate_vault(fname, size, encrypt, args.layout)
+                ops = _suite_ops(fname, size, encrypt, args.layout)
+                for op in SUITE_OPS:
+                    if op not in ops:
+                        continue
+                    result = dict(mode=mode, layout=args.layout, accounts=size,
+                                  op=op, **_measure(ops[op], args.repeat))
+                    results.append(result)
+                    print("{:<10} {:>8} {:<7} {:>10.2f} {:>10} {:>14}".format(
+                        mode, size, op, result["seconds"] * 1000,
+                        result["peak_kb"], result["bytes_written"]))
+                for name in os.listdir(tmpdir):
+                    os.remove(os.path.join(tmpdir, name))
+    finally:
+        shutil.rmtree(tmpdir)
+    report = {"version": RESULTS_VERSION, "created": time.time(),
+              "python": platform.python_version(),
+              "platform": platform.platform(), "results": results}
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=1)
+        print("Results written to", args.output)
+    if args.compare:
+        with open(args.compare) as previous:
+            regressions = compare_results(json.load(previous), report,
+                                          args.threshold)
+        if regressions:
+            raise SystemExit("{} regression(s) over {:.0%}".format(
+                regressions, args.threshold))
+
+
+def compare_results(old, new, threshold):
+    """
+    Prints how each result of new compares with the same operation in old
+    :param old: results (dict, as saved by bench_suite) to compare against
+    :param new: results (dict)
+    :param threshold: slow-down (or memory growth) past which a result is a
+    regression, as a fraction, e.g. 0.2 for 20%. Below COMPARE_FLOORS, the
+    change is taken as a share of the floor instead of the earlier result
+    :return: number of regressions
+    """
+    def key(result):
+        return (result["mode"], result.get("layout", 'single'),
+                result["accounts"], result["op"])
+
+    if old.get("version") != RESULTS_VERSION:
+        raise RuntimeError("Unsupported results version {}".format(
+            old.get("version")))
+    previous = {key(result): result for result in old["results"]}
+    regressions = 0
+    print("{:<10} {:>8} {:<7} {:>9} {:>9}  {}".format(
+        "mode", "accounts", "op", "time", "peak", ""))
+    for result in new["results"]:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        changes = []
+        flags = []
+        for field in ("seconds", "peak_kb"):
+            change = (result[field] - before[field]) / \
+                max(before[field], COMPARE_FLOORS[field])
+            changes.append(change)
+            if change > threshold:
+                flags.append("time" if field == "seconds" else "memory")
+        regressions += bool(flags)
+        print("{:<10} {:>8} {:<7} {:>+9.0%} {:>+9.0%}  {}".format(
+            result["mode"], result["accounts"], result["op"], changes[0],
+            changes[1], "REGRESSION ({})".format(", ".join(flags))
+            if flags else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ezpass benchmarks')
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    kdf = sub.add_parser('kdf', help='key derivations per operation')
+    kdf.add_argument('-n', '--accounts', type=int, default=10,
+                     help='number of accounts to create')
+    kdf.set_defaults(func=bench_kdf)
+
+    index = sub.add_parser('index', help='org lookup & delete scaling')
+    index.add_argument('-s', '--sizes', type=int, nargs='+',
+                       default=[1000, 10000, 100000],
+                       help='numbers of accounts to test')
+    index.set_defaults(func=bench_index)
+
+    record = sub.add_parser('record', help='stored bytes per account')
+    record.add_argument('-n', '--accounts', type=int, default=10000,
+                        help='number of accounts to store')
+    record.set_defaults(func=bench_record)
+
+    password = sub.add_parser('password', help='password generation')
+    password.add_argument('-n', '--count', type=int, default=10000,
+                          help='number of passwords')
+    password.add_argument('-l', '--length', type=int, default=16,
+                          help='password length')
+    password.set_defaults(func=bench_password)
+
+    journal = sub.add_parser('journal', help='bytes written per change')
+    journal.add_argument('-n', '--accounts', type=int, default=100000,
+                         help='number of accounts in the file')
+    journal.set_defaults(func=bench_journal)
+
+    serializer = sub.add_parser('serializer',
+                                help='serializer save/load time & size')
+    serializer.add_argument('-s', '--sizes', type=int, nargs='+',
+                            default=[1000, 10000, 100000],
+                            help='numbers of accounts to test')
+    serializer.set_defaults(func=bench_serializer)
+
+    lookup = sub.add_parser('lookup', help='open + single lookup per layout')
+    lookup.add_argument('-n', '--accounts', type=int, default=100000,
+                        help='number of accounts in the file')
+    lookup.set_defaults(func=bench_lookup)
+
+    rss = sub.add_parser('rss', help='peak memory opening a large file')
+    rss.add_argument('-n', '--accounts', type=int, default=200000,
+                     help='number of accounts in the file')
+    rss.set_defaults(func=bench_rss)
+
+    agent = sub.add_parser('agent', help='password fetch with/without agent')
+    agent.add_argument('-n', '--accounts', type=int, default=1000,
+                       help='number of accounts in the file')
+    agent.add_argument('-c', '--calls', type=int, default=20,
+                       help='number of lookups to time')
+    agent.set_defaults(func=bench_agent)
+
+    vaults = sub.add_parser('vaults', help='unlocking several files')
+    vaults.add_argument('-v', '--vaults', type=int, default=5,
+                        help='number of files')
+    vaults.add_argument('-n', '--accounts', type=int, default=1000,
+                        help='number of accounts per file')
+    vaults.set_defaults(func=bench_vaults)
+
+    chunked = sub.add_parser('chunked', help="'chunked' layout encrypt & "
+                                             "decrypt time per thread count")
+    chunked.add_argument('-c', '--chunks', type=int, nargs='+',
+                         default=[1, 8, 32], help='numbers of chunks')
+    chunked.add_argument('-w', '--workers', type=int, nargs='+',
+                         default=[1, 2, 4, 8], help='numbers of threads')
+    chunked.set_defaults(func=bench_chunked)
+
+    imports = sub.add_parser('import', help="'import ezpass' time")
+    imports.add_argument('-r', '--repeat', type=int, default=3,
+                         help='runs; the fastest is kept')
+    imports.add_argument('-b', '--budget', type=float,
+                         default=IMPORT_BUDGET_MS,
+                         help='most milliseconds the import may take '
+                              '(default: {})'.format(IMPORT_BUDGET_MS))
+    imports.add_argument('-t', '--top', type=int, default=10,
+                         help='number of slowest modules to list')
+    imports.set_defaults(func=bench_import)
+
+    getmany = sub.add_parser('getmany',
+                             help='fetching many credentials at once')
+    getmany.add_argument('-n', '--accounts', type=int, default=1000,
+                         help='number of accounts in the file')
+    getmany.add_argument('-o', '--orgs', type=int, nargs='+',
+                         default=[1, 10, 40],
+                         help='numbers of orgs to fetch')
+    getmany.set_defaults(func=bench_getmany)
+
+    suite = sub.add_parser('suite', help='every operation on synthetic '
+                                         'vaults; JSON results & comparison')
+    suite.add_argument('-s', '--sizes', type=int, nargs='+',
+                       default=[1000, 10000, 100000],
+                       help='numbers of accounts to test (up to 1000000)')
+    suite.add_argument('-m', '--modes', type=str, nargs='+',
+                       choices=['plain', 'encrypted'],
+                       default=['plain', 'encrypted'], help='vault kinds')
+    suite.add_argument('--layout', type=str, choices=LAYOUTS,
+                       default='single', help='layout of encrypted vaults')
+    suite.add_argument('-r', '--repeat', type=int, default=3,
+                       help='runs per operation; the fastest is kept')
+    suite.add_argument('-o', '--output', type=str,
+                       help='file to save the results to (JSON)')
+    suite.add_argument('-c', '--compare', type=str,
+                       help='earlier results file to compare with; exits '
+                            'with an error if anything regressed')
+    suite.add_argument('-t', '--threshold', type=float, default=0.2,
+                       help='slow-down or memory growth counted as a '
+                            'regression (default: 0.2, i.e. 20%%)')
+    suite.set_defaults(func=bench_suite)
+
+    search = sub.add_parser('search',
+                            help='org search & completion time')
+    search.add_argument('-n', '--orgs', type=int, default=100000,
+                        help='number of orgs to search')
+    search.add_argument('-c', '--calls', type=int, default=100,
+                        help='number of times to run each query')
+    search.add_argument('-l', '--limit', type=int, default=10,
+                        help='most matches per query')
+    search.set_defaults(func=bench_search)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,51 +2,27 @@
 Main file for running ezpass. For more instructions, see repo's README:
 https://github.com/jchenj/ezpass
 """
-import _pickle
 import shlex
 import argparse
+import atexit
 import cmd
 import getpass
+import json
 import os
 import sys
-import pprint
-import cryptography
-
-#########################################
-# Enable tab-completion for cmd.cmd
-# https://pewpewthespells.com/blog/osx_readline.html
-import readline
-if 'libedit' in readline.__doc__:
-    readline.parse_and_bind("bind ^I rl_complete")
-else:
-    readline.parse_and_bind("tab: complete")
-#########################################
+import time
 
+# Modules only some commands need (cryptography, readline, pyperclip, pprint
+# & the agent client) are imported where they are used, so that --help,
+# unencrypted files and lookups answered by the agent start quickly. See
+# test_import_time in test_ezpass.py
 from util import *
-from pwfile import PwFile
+from pwfile import PwFile, NotEncrypted, CorruptFile, LAYOUTS
+from pwfile import DEFAULT_ITERATIONS
+from accountdb import AccountDB
 from account import Account
-
-
-# ! TODO - rename class to AcList?
-# ! TODO - take acname out of class?
-# ! TODO - rename acname to username?
-#
-# class AccountDB:
-#     def __init__(self, pwfile: PwFile) -> None:
-#         """
-#         :param pwfile: PwFile instance
-#         :param org: name of organization that account belongs to (e.g. Bank of America)
-#         # :param acname: account name (cannot contain spaces, newlines or tabs)
-#         """
-#         assert pwfile is not None
-#         self.pwfile = pwfile
-#         # TODO read the pwfile,
-#         # populate a local representation of the accounts
-#         self.accounts = self.pwfile.readFile()
-#
-#     def get_account_pass(self, orgname):
-#         # 1. find account with orgname
-#         # 2. print/copy account's username/pass
+import stats
+import transfer
 
 
 class PassShell(cmd.Cmd):
@@ -60,10 +36,31 @@ class PassShell(cmd.Cmd):
         self.doc_header = """[n -o org] Add new account
 [d -o org] Delete account
 [g -o org] Get password
+[gm -o org [org ...] | --all] Get many credentials as export lines, .netrc or JSON
 [ch -o org -p pass] Change password
+[rot -o org [org ...] | --all] Rotate passwords (globs like 'aws-*' too)
+[s query] Search org names (prefix, substring or misspelled)
+[stats] Show time spent decrypting, deriving keys, writing, ...
+[w] Write changes to file
 [q] Quit
 """
         self.pfile = pfile
+        # all commands share one session; changes are written on w or q
+        self.db = AccountDB(pfile)
+        PassShell._enable_tab_completion()
+
+    @staticmethod
+    def _enable_tab_completion():
+        # Enable tab-completion for cmd.cmd
+        # https://pewpewthespells.com/blog/osx_readline.html
+        import readline
+        if 'libedit' in readline.__doc__:
+            readline.parse_and_bind("bind ^I rl_complete")
+        else:
+            readline.parse_and_bind("tab: complete")
+        # complete whole org names such as 'aws-prod' or 'me@work', not the
+        # part after the last '-' or '@'
+        readline.set_completer_delims(" \t\n")
 
     # ----- basic ezpass commands -----
     # Must have pwfile before interactive mode can be used
@@ -75,46 +72,121 @@ class PassShell(cmd.Cmd):
             # catching parse_args errors
             return
         except:
+            import pprint
             pprint.pprint(sys.exc_info())
             parser.print_help()
             return
 
-    def do_n(self, line):
-        """[n -o org] Add a new org: NEWAC --org-name --pw-length --set-acpass"""
-        parser = argparse.ArgumentParser(prog="newac")
+    # ----- completion of org names -----
+    # Served from the session's org index, so a keypress never reads the file
+
+    def complete_org(self, text, line, begidx, options, many=False):
+        """
+        Completes text to the orgs it starts, if it is the value of one of
+        options (e.g. '-o')
+        :param many: whether or not the option takes several orgs
+        :return: list of completions
+        """
+        words = line[:begidx].split()
+        flags = [i for i, word in enumerate(words) if word.startswith('-')]
+        if not flags or words[flags[-1]] not in options:
+            return []
+        if not many and flags[-1] != len(words) - 1:
+            return []
+        return self.db.complete(text)
+
+    def complete_g(self, text, line, begidx, endidx):
+        return self.complete_org(text, line, begidx, ('-o', '--org-name'))
+
+    complete_d = complete_g
+    complete_ch = complete_g
+
+    def complete_rot(self, text, line, begidx, endidx):
+        return self.complete_org(text, line, begidx, ('-o', '--org-names'),
+                                 many=True)
+
+    complete_gm = complete_rot
+
+    # ----- command line parsers -----
+    # Shared with batch mode (see run_batch), which builds them without -h
+
+    @staticmethod
+    def parser_n(add_help=True):
+        parser = argparse.ArgumentParser(prog="newac", add_help=add_help)
         parser.add_argument('-o', '--org-name', type=str, help='new org '
                                                                 'name',
                             required=True)
+        parser.add_argument('-u', '--username', type=str, required=False,
+                            help='username (default: ask for it)')
         parser.add_argument('-l', '--pw-length', type=int, required=False,
                             default=8, help='password length')
         parser.add_argument('-p', '--set-acpass', action='store_true',
                             help='set specified password', required=False)
+        parser.add_argument('--password', type=str, required=False,
+                            help='set this password instead of a random one')
+        return parser
+
+    @staticmethod
+    def parser_d(add_help=True):
+        parser = argparse.ArgumentParser(prog="delac", add_help=add_help)
+        parser.add_argument('-o', '--org-name', type=str, help='org name',
+                            required=True)
+        return parser
+
+    @staticmethod
+    def parser_g(add_help=True):
+        parser = argparse.ArgumentParser(prog='getacpass', add_help=add_help)
+        parser.add_argument('-o', '--org-name', type=str, help='org name',
+                            required=True)
+        parser.add_argument('--print', action='store_true',
+                            help='print password to screen', required=False,
+                            default=False)
+        return parser
+
+    @staticmethod
+    def parser_ch(add_help=True):
+        parser = argparse.ArgumentParser(prog='chacpass', add_help=add_help)
+        parser.add_argument('-o', '--org-name', type=str, help='org name',
+                            required=True)
+        parser.add_argument('-p', '--set-acpass', action='store_true',
+                            help='set specified password', required=False)
+        parser.add_argument('--password', type=str, required=False,
+                            help='set this password instead of a random one')
+        parser.add_argument('-l', '--pw-length', type=int, required=False,
+                            default=8, help='password length')
+        return parser
+
+    def do_n(self, line):
+        """[n -o org] Add a new org: NEWAC --org-name --username --pw-length --set-acpass --password"""
+        parser = PassShell.parser_n()
 
         def body():
             args = parser.parse_args(shlex.split(line))
             if args.pw_length < 1:
                 raise RuntimeError(
                     "Error. Password length must be greater than 0.")
-            account = Account(self.pfile, args.org_name)
+            account = Account(self.db, args.org_name)
             print("Creating new account for:", args.org_name)
-            acname = input("Enter username: ")
+            acname = args.username
+            if acname is None:
+                acname = input("Enter username: ")
             account.create_new_account(acname, ALPHABET, args.pw_length)
-            if args.set_acpass is not None:
+            if args.set_acpass:
                 specified_pass = getpass.getpass(prompt="Enter password: ")
                 account.set_acpass(specified_pass)
+            elif args.password is not None:
+                account.set_acpass(args.password)
             print("Account created for:", args.org_name)
 
         self.run_body_handle_exceptions(body, parser)
 
     def do_d(self, line):
         """[d -o org] Delete account for specified org: DELAC --org-name"""
-        parser = argparse.ArgumentParser(prog="delac")
-        parser.add_argument('-o', '--org-name', type=str, help='org name',
-                            required=True)
+        parser = PassShell.parser_d()
 
         def body():
             args = parser.parse_args(shlex.split(line))
-            account = Account(self.pfile, args.org_name)
+            account = Account(self.db, args.org_name)
             account.delete_account()
             print("Deleted account for:", args.org_name)
 
@@ -122,16 +194,11 @@ class PassShell(cmd.Cmd):
 
     def do_g(self, line):
         """[g -o org] Get password for specified org: GETACPASS --org-name --print"""
-        parser = argparse.ArgumentParser(prog='getacpass')
-        parser.add_argument('-o', '--org-name', type=str, help='org name',
-                            required=True)
-        parser.add_argument('--print', action='store_true',
-                            help='print password to screen', required=False,
-                            default=False)
+        parser = PassShell.parser_g()
 
         def body():
             args = parser.parse_args(shlex.split(line))
-            account = Account(self.pfile, args.org_name)
+            account = Account(self.db, args.org_name)
             account.get_password_from_file(args.print)
 
             if args.print is False:
@@ -140,43 +207,472 @@ class PassShell(cmd.Cmd):
 
         self.run_body_handle_exceptions(body, parser)
 
+    def do_gm(self, line):
+        """[gm -o org [org ...] | --all] Print usernames & passwords of many orgs: GETMANY --org-names --all --output"""
+        parser = argparse.ArgumentParser(prog='getmany')
+        orgs = parser.add_mutually_exclusive_group(required=True)
+        orgs.add_argument('-o', '--org-names', type=str, nargs='+',
+                          help='org names or glob patterns')
+        orgs.add_argument('--all', action='store_true', help='every org')
+        parser.add_argument('--output', type=str,
+                            choices=transfer.CREDENTIAL_FORMATS,
+                            default='export', help='output format')
+
+        def body():
+            args = parser.parse_args(shlex.split(line))
+            missing = get_many(self.db, args.org_names, args.output,
+                               sys.stdout)
+            if missing:
+                print("No accounts matched:", " ".join(missing))
+
+        self.run_body_handle_exceptions(body, parser)
+
     def do_ch(self, line):
-        """[ch -o org -p pass] Change password for specified org: CHACPASS --org-name set-acpass pw-length"""
-        parser = argparse.ArgumentParser(prog='chacpass')
-        parser.add_argument('-o', '--org-name', type=str, help='org name',
-                            required=True)
-        parser.add_argument('-p', '--set-acpass', action='store_true',
-                            help='set specified password', required=False)
-        parser.add_argument('-l', '--pw-length', type=int, required=False,
-                            default=8, help='password length')
+        """[ch -o org -p pass] Change password for specified org: CHACPASS --org-name set-acpass password pw-length"""
+        parser = PassShell.parser_ch()
 
         def body():
             args = parser.parse_args(shlex.split(line))
-            account = Account(self.pfile, args.org_name)
-            if args.set_acpass is None:
-                account.set_acpass_rand(ALPHABET, args.pw_length)
-            else:
+            account = Account(self.db, args.org_name)
+            if args.set_acpass:
                 specified_pass = getpass.getpass(prompt="Enter password: ")
                 account.set_acpass(specified_pass)
+            elif args.password is not None:
+                account.set_acpass(args.password)
+            else:
+                account.set_acpass_rand(ALPHABET, args.pw_length)
             print("Password changed for account:", args.org_name)
 
         self.run_body_handle_exceptions(body, parser)
 
+    def do_rot(self, line):
+        """[rot -o org [org ...] | --all] Rotate passwords for many orgs: ROTATE --org-names --all --pw-length"""
+        parser = argparse.ArgumentParser(prog='rotate')
+        orgs = parser.add_mutually_exclusive_group(required=True)
+        orgs.add_argument('-o', '--org-names', type=str, nargs='+',
+                          help='org names or glob patterns')
+        orgs.add_argument('--all', action='store_true', help='every org')
+        parser.add_argument('-l', '--pw-length', type=int, required=False,
+                            default=8, help='password length')
+
+        def body():
+            args = parser.parse_args(shlex.split(line))
+            rotate_passwords(self.db, args.org_names, ALPHABET, args.pw_length)
+
+        self.run_body_handle_exceptions(body, parser)
+
+    def do_s(self, line):
+        """[s query] Search org names by prefix, substring or approximate spelling: SEARCH query --limit"""
+        parser = argparse.ArgumentParser(prog='search')
+        parser.add_argument('query', type=str, help='part of an org name')
+        parser.add_argument('-n', '--limit', type=int, required=False,
+                            default=10, help='most matches to list (0: all)')
+
+        def body():
+            args = parser.parse_args(shlex.split(line))
+            search_orgs(self.db, args.query, args.limit)
+
+        self.run_body_handle_exceptions(body, parser)
+
+    def do_stats(self, line):
+        """[stats] Show time spent in key derivation, decryption, (de)serializing and file I/O since the shell started: STATS --json --reset"""
+        parser = argparse.ArgumentParser(prog='stats')
+        parser.add_argument('--json', action='store_true',
+                            help='print as JSON')
+        parser.add_argument('--reset', action='store_true',
+                            help='start counting again from zero')
+
+        def body():
+            args = parser.parse_args(shlex.split(line))
+            print(stats.to_json() if args.json else stats.format_report())
+            if args.reset:
+                stats.reset()
+
+        self.run_body_handle_exceptions(body, parser)
+
+    def do_w(self, line):
+        """[w] Write changes to file"""
+        self.db.flush()
+        print("Changes written to:", self.pfile.get_fname())
+
     def do_q(self, line):
         """[q] Quit the program"""
+        self.db.flush()
         print("")
         print("Goodbye!")
         sys.exit(0)
 
+    def do_EOF(self, line):
+        """Quit the program on end of input"""
+        return self.do_q(line)
+
+
+def rotate_passwords(db: AccountDB, patterns: list, alphabet: str,
+                     password_length: int) -> None:
+    """
+    Rotates passwords of all orgs matching patterns and prints a summary
+    :param db: AccountDB session
+    :param patterns: list of org names or glob patterns; None for all orgs
+    :param alphabet: string of full alphabet
+    :param password_length: length of password
+    :return: None
+    """
+    if password_length < 1:
+        raise RuntimeError("Error. Password length must be greater than 0.")
+    orgs, missing = db.select(patterns)
+    db.rotate(orgs, alphabet, password_length)
+    print("Rotated passwords for {} account(s):".format(len(orgs)))
+    for org in orgs:
+        print("  " + org)
+    if missing:
+        print("No accounts matched:", " ".join(missing))
+    return
+
+
+def get_many(db: AccountDB, patterns: list, fmt: str, out) -> list:
+    """
+    Writes the usernames and passwords of all orgs matching patterns to out,
+    from one read of the file
+    :param db: AccountDB session
+    :param patterns: list of org names or glob patterns; None for all orgs
+    :param fmt: one of transfer.CREDENTIAL_FORMATS
+    :param out: text file to write to
+    :return: list of patterns that matched no account
+    """
+    orgs, missing = db.select(patterns)
+    if orgs:
+        out.write(transfer.format_credentials([db.find(org) for org in orgs],
+                                              fmt))
+    return missing
+
+
+def is_multi_get(orgs: list, fmt: str) -> bool:
+    """
+    :param orgs: values of -g; None for --all
+    :param fmt: value of --output
+    :return: whether -g asks for several accounts, printed in an output
+    format, rather than one account's password in the paste buffer
+    """
+    return orgs is None or fmt is not None or len(orgs) > 1 or \
+        any(c in orgs[0] for c in '*?[')
+
+
+def search_orgs(db: AccountDB, query: str, limit: int) -> None:
+    """
+    Prints the orgs matching query, best match first
+    :param db: AccountDB session
+    :param query: part or misspelling of an org name
+    :param limit: most matches to print; 0 for all
+    :return: None
+    """
+    if limit < 0:
+        raise RuntimeError("Error. Limit must not be negative.")
+    matches = db.search(query, limit)
+    if not matches:
+        print("No orgs match '{}'".format(query))
+        return
+    print("{} org(s) matching '{}':".format(len(matches), query))
+    for match in matches:
+        print("  {} ({})".format(match.org, match.kind))
+    return
+
+
+# commands of a batch script (see run_batch): they take the same arguments as
+# in the interactive shell
+BATCH_COMMANDS = ['g', 'n', 'ch', 'd']
+
+
+def _parse_batch_line(line: str) -> tuple:
+    """
+    :param line: a shell command line (e.g. 'g -o github') or a JSON object
+    with "cmd" and either "args" (a list or a command line) or the command's
+    long options as keys (e.g. {"cmd": "g", "org-name": "github"})
+    :return: tuple of (command, list of arguments)
+    """
+    if not line.startswith('{'):
+        argv = _split_batch_args(line)
+        if not argv:
+            raise RuntimeError("Missing command")
+        return argv[0], argv[1:]
+    try:
+        command = json.loads(line)
+    except ValueError as e:
+        raise RuntimeError("Invalid JSON: {}".format(e))
+    if not isinstance(command, dict) or not isinstance(command.get('cmd'),
+                                                       str):
+        raise RuntimeError("JSON command must be an object with a 'cmd'")
+    argv = command.pop('args', [])
+    if isinstance(argv, str):
+        argv = _split_batch_args(argv)
+    elif not isinstance(argv, list) or \
+            not all(isinstance(arg, str) for arg in argv):
+        raise RuntimeError("'args' must be a command line or a list of "
+                           "strings")
+    for key, value in command.items():
+        if key == 'cmd' or value is False or value is None:
+            continue
+        argv.append('--' + key.replace('_', '-'))
+        if value is not True:
+            argv.append(str(value))
+    return command['cmd'], argv
+
+
+def _split_batch_args(line: str) -> list:
+    try:
+        return shlex.split(line)
+    except ValueError as e:
+        # e.g. an unbalanced quote
+        raise RuntimeError("Invalid command line: {}".format(e))
+
+
+def _run_batch_command(db: AccountDB, command: str, args) -> dict:
+    """
+    Runs one parsed batch command against db, without prompting
+    :return: dict of result fields
+    """
+    if getattr(args, 'set_acpass', False):
+        raise RuntimeError("-p needs a terminal; use --password")
+    account = Account(db, args.org_name)
+    if command == 'g':
+        record = db.find(args.org_name)
+        if record is None:
+            raise RuntimeError("Account for org '{}' not in file".format(
+                args.org_name))
+        return {"org": record.org, "username": record.acname,
+                "password": record.acpassword}
+    if command == 'd':
+        account.delete_account()
+        return {"org": args.org_name}
+    if args.pw_length < 1:
+        raise RuntimeError("Error. Password length must be greater than 0.")
+    if command == 'n':
+        if args.username is None:
+            raise RuntimeError("Missing --username")
+        # a rejected password must not leave a new account behind
+        account.create_new_account(args.username, ALPHABET, args.pw_length,
+                                   args.password)
+    elif args.password is not None:
+        account.set_acpass(args.password)
+    else:
+        account.set_acpass_rand(ALPHABET, args.pw_length)
+    record = db.find(args.org_name)
+    return {"org": record.org, "username": record.acname,
+            "password": record.acpassword}
+
+
+def run_batch(db: AccountDB, lines, out, commit_every: int = 0) -> tuple:
+    """
+    Runs a script of commands (see BATCH_COMMANDS) against db and writes one
+    JSON object per command to out, with "line", "cmd" and "ok" and either
+    the account ("org", "username", "password") or an "error". A failed
+    command doesn't stop the script.
+    Changes are written to the file once at the end, or after every
+    commit_every changes
+    :param db: AccountDB session
+    :param lines: iterable of script lines; blank lines and lines starting
+    with '#' are skipped (see _parse_batch_line for the line format)
+    :param out: text file to write results to
+    :param commit_every: number of changes per write; 0 to write once at the
+    end
+    :return: tuple of (commands run, commands failed)
+    :side effect: updated file
+    """
+    if commit_every < 0:
+        raise RuntimeError("Error. Commit interval must not be negative.")
+    # without -h, which would print the usage to out and exit: a '-h' in
+    # the script is reported as an unrecognized argument instead
+    parsers = {command: getattr(PassShell, 'parser_' + command)(add_help=False)
+               for command in BATCH_COMMANDS}
+
+    def error(message):
+        raise RuntimeError(message)
+
+    for parser in parsers.values():
+        # report bad arguments in the command's result, not on stderr
+        parser.error = error
+    run = failed = pending = 0
+    try:
+        for line_num, line in enumerate(lines, 1):
+            line = line.strip()
+            if line == "" or line.startswith('#'):
+                continue
+            run += 1
+            result = {"line": line_num}
+            try:
+                command, argv = _parse_batch_line(line)
+                result["cmd"] = command
+                if command not in parsers:
+                    raise RuntimeError("Unknown command '{}'. Use one of: "
+                                       "{}".format(command,
+                                                   ", ".join(BATCH_COMMANDS)))
+                try:
+                    args = parsers[command].parse_args(argv)
+                except SystemExit:
+                    raise RuntimeError("Invalid arguments")
+                result.update(_run_batch_command(db, command, args))
+                result["ok"] = True
+                if command != 'g':
+                    pending += 1
+            except RuntimeError as e:
+                failed += 1
+                result["ok"] = False
+                result["error"] = str(e)
+            out.write(json.dumps(result) + "\n")
+            if commit_every and pending >= commit_every:
+                db.flush()
+                pending = 0
+    finally:
+        # changes already reported as done are kept even if the script
+        # can't be read to the end
+        db.flush()
+        out.flush()
+    return run, failed
+
+
+def open_vaults(fnames: list, encrypt: bool, **options):
+    """
+    Prompts for the password of every file, then unlocks them all in
+    parallel. Prompts again for the files whose password was wrong
+    :param fnames: list of file names
+    :param encrypt: whether or not the files are encrypted
+    :param options: other PwFile arguments, used for every file
+    :return: vaults.Vaults session over the files
+    """
+    import vaults
+    if encrypt:
+        from cryptography.fernet import InvalidToken
+
+    passwords = dict.fromkeys(fnames)
+    pwfiles = {}
+    pending = list(fnames)
+    while pending:
+        if encrypt:
+            for fname in pending:
+                passwords[fname] = getpass.getpass(
+                    prompt="Enter password for file {}: ".format(fname))
+        opened, errors = vaults.unlock(
+            pending, [passwords[fname] for fname in pending], encrypt,
+            **options)
+        pwfiles.update(opened)
+        pending = []
+        for fname, error in errors.items():
+            if encrypt and isinstance(error, InvalidToken):
+                print("Error: incorrect password for file {}. Please try "
+                      "again".format(fname))
+                pending.append(fname)
+            elif isinstance(error, (UnicodeDecodeError, NotEncrypted)):
+                print("Error: Couldn't open file {}. Try running with "
+                      "--no-encrypt".format(fname))
+                sys.exit(1)
+            else:
+                raise error
+    return vaults.Vaults([pwfiles[fname] for fname in fnames])
+
+
+def get_from_vaults(vault_set, org: str, print_to_screen: bool) -> None:
+    """
+    Gets the password for org from the first of several files that holds it
+    (all of them with print_to_screen)
+    :param vault_set: vaults.Vaults session
+    :param org: org name to get account password for
+    :param print_to_screen: print passwords instead of using the paste buffer
+    :return: None
+    """
+    found = vault_set.find(org)
+    if not found:
+        raise RuntimeError("Account for org '{}' not in any file".format(org))
+    if print_to_screen:
+        for source, account in found:
+            print("[{}]".format(source))
+            Account.show_password(account, True)
+        return
+    source, account = found[0]
+    Account.show_password(account, False)
+    print("Password for account '{}' from {} in paste buffer".format(
+        org, source))
+    if len(found) > 1:
+        print("Also in:", " ".join(source for source, account in found[1:]))
+    return
+
+
+def search_vaults(vault_set, query: str, limit: int) -> None:
+    """
+    Prints the orgs of several files matching query, best match first
+    :param vault_set: vaults.Vaults session
+    :param query: part or misspelling of an org name
+    :param limit: most matches to print; 0 for all
+    :return: None
+    """
+    if limit < 0:
+        raise RuntimeError("Error. Limit must not be negative.")
+    matches = vault_set.search(query, limit)
+    if not matches:
+        print("No orgs match '{}'".format(query))
+        return
+    print("{} org(s) matching '{}':".format(len(matches), query))
+    for source, match in matches:
+        print("  {} ({}, {})".format(match.org, match.kind, source))
+    return
+
+
+def print_stats(format: str) -> None:
+    """
+    Prints what stats collected to stderr
+    :param format: 'text' or 'json'
+    :return: None
+    """
+    if format == 'json':
+        print(stats.to_json(), file=sys.stderr)
+    else:
+        print(stats.format_report(), file=sys.stderr)
+    return
+
+
+def get_from_agent(fname: str, org: str, print_to_screen: bool) -> bool:
+    """
+    Gets the password for org from a running agent (see agent.py) that holds
+    fname unlocked, without prompting for the file password
+    :param fname: name of password file
+    :param org: org name to get account password for
+    :param print_to_screen: print password instead of using the paste buffer
+    :return: True if the agent answered, False if there is no agent or it
+    doesn't hold fname
+    """
+    import agent
+
+    client = agent.connect()
+    if client is None:
+        return False
+    try:
+        account = client.find(fname, org)
+    except (RuntimeError, ValueError, OSError):
+        # not unlocked there, an error reply (RuntimeError) or an agent that
+        # died mid-request (no or a partial reply: ValueError)
+        return False
+    if account is None:
+        raise RuntimeError("Account for org '{}' not in file".format(org))
+    Account.show_password(account, print_to_screen)
+    if print_to_screen is False:
+        print("Password for account '{}' in paste buffer".format(org))
+    return True
+
 
 def mainfunc():
     parser = argparse.ArgumentParser(description='Password manager')
     # required
-    parser.add_argument('-f', '--file', type=str, help='file name',
-                        required=True)
+    parser.add_argument('-f', '--file', type=str, nargs='+', action='extend',
+                        help='file name; -g and -s take several, which are '
+                             'unlocked in parallel', required=True)
     # choose one
-    parser.add_argument('-g', '--get-acpass', type=str,
-                        help='org name to get account password for')
+    parser.add_argument('-g', '--get-acpass', type=str, nargs='*',
+                        help="org name to get account password for; several "
+                             "org names or glob patterns (or --all) print "
+                             "all their usernames & passwords (see --output)")
+    parser.add_argument('--output', type=str,
+                        choices=transfer.CREDENTIAL_FORMATS,
+                        help="format -g prints accounts in: shell 'export' "
+                             "lines (default for several orgs), .netrc "
+                             "entries or JSON")
     parser.add_argument('-no', '--new-org', type=str, help='new org name')
     parser.add_argument('-d', '--delete-account', type=str,
                         help='org to delete account for')
@@ -184,6 +680,30 @@ def mainfunc():
                         help='whether or not to create new file')
     parser.add_argument('-cp', '--change-acpass', type=str,
                         help='org to change password for')
+    parser.add_argument('-rot', '--rotate', type=str, nargs='*',
+                        help="orgs to change passwords for in one write: "
+                             "org names or glob patterns (or --all)")
+    parser.add_argument('--all', action='store_true',
+                        help='with -g or -rot: every org in the file')
+    parser.add_argument('-s', '--search', type=str,
+                        help='list orgs starting with, containing or spelled '
+                             'like SEARCH')
+    parser.add_argument('--limit', type=int, default=10,
+                        help='most matches -s lists (default: 10, 0: all)')
+    parser.add_argument('--import', type=str, dest='import_file',
+                        help='CSV or JSON-lines file of accounts to add')
+    parser.add_argument('--export', type=str, dest='export_file',
+                        help='new CSV or JSON-lines file to write all '
+                             'accounts to (passwords in plaintext)')
+    parser.add_argument('--format', type=str, choices=transfer.FORMATS,
+                        help='format of --import/--export file (default: '
+                             'from file extension)')
+    parser.add_argument('--batch', type=str, nargs='?', const='-',
+                        help='run the commands in script BATCH (default: '
+                             'stdin) and print one JSON result per command')
+    parser.add_argument('--commit-every', type=int, default=0,
+                        help='with --batch: write the file after every N '
+                             'changes (default: once at the end)')
     parser.add_argument('-sp', '--set-acpass', action='store_true',
                         help='whether or not to use specified password')
     # optional
@@ -194,6 +714,35 @@ def mainfunc():
                         help='password length', required=False, default=8)
     parser.add_argument('--no-encrypt', default=False, action='store_true',
                         help='if specified, no encryption will be used')
+    parser.add_argument('--backup', default=False, action='store_true',
+                        help='keep the previous version of the file as '
+                             'FILE.bak when writing')
+    parser.add_argument('--journal', default=False, action='store_true',
+                        help='append changes to FILE.journal instead of '
+                             'rewriting the whole file')
+    parser.add_argument('--kdf-target-ms', type=int,
+                        help='with -nf or --rekey: pick a key derivation cost '
+                             'that takes about this long to unlock the file '
+                             'on this machine')
+    parser.add_argument('--rekey', action='store_true',
+                        help='re-encrypt file with a new random salt')
+    parser.add_argument('--layout', type=str, choices=LAYOUTS,
+                        help="layout of an encrypted file: 'single' "
+                             "(default), 'indexed' (every account "
+                             "encrypted on its own, for fast lookups) or "
+                             "'chunked' (encrypted in 1 MB pieces on a "
+                             "thread pool, for very large files)")
+    parser.add_argument('--agent-add', action='store_true',
+                        help='unlock file in the running agent (see '
+                             'agent.py), so that -g needs no password')
+    parser.add_argument('--agent-lock', action='store_true',
+                        help='make the running agent forget file')
+    parser.add_argument('--stats', type=str, nargs='?', const='text',
+                        choices=['text', 'json'],
+                        help='on exit, print the time spent in key '
+                             'derivation, decryption, (de)serializing and '
+                             'file I/O to stderr, as a table (default) or '
+                             'JSON')
     parser.add_argument('-a', '--alphabet', type=str, help='full alphabet',
                         required=False)
     parser.add_argument('-i', '--interactive', action='store_true',
@@ -201,17 +750,46 @@ def mainfunc():
 
     args = parser.parse_args()
 
-    print(args)
-
-    fname = args.file
+    # --all stands in for the org names, so an org named 'all' is just an org
+    for flag, orgs in [("-g", args.get_acpass), ("-rot", args.rotate)]:
+        if orgs is not None and bool(orgs) == args.all:
+            raise RuntimeError("Error. {} takes org names or --all".format(
+                flag))
+    if args.all and args.get_acpass is None and args.rotate is None:
+        raise RuntimeError("Error. --all goes with -g or -rot")
+    selected = None if args.all else args.get_acpass
+    multi_get = args.get_acpass is not None and is_multi_get(selected,
+                                                             args.output)
+    # batch results and credentials on stdout are for programs to read
+    if args.batch is None and not multi_get:
+        print(args)
+
+    # the interactive shell's stats command reports from the start too
+    if args.stats or args.interactive:
+        stats.enable()
+    if args.stats:
+        atexit.register(print_stats, args.stats)
+
+    fnames = args.file
+    fname = fnames[0]
     get_acpass_int = int(args.get_acpass is not None)
     new_org_int = int(args.new_org is not None)
     delete_account_int = int(args.delete_account is not None)
     change_acpass_int = int(args.change_acpass is not None)
+    rotate_int = int(args.rotate is not None)
+    search_int = int(args.search is not None)
+    import_int = int(args.import_file is not None)
+    export_int = int(args.export_file is not None)
+    batch_int = int(args.batch is not None)
+    rekey_int = int(args.rekey is True)
+    agent_add_int = int(args.agent_add is True)
+    agent_lock_int = int(args.agent_lock is True)
     new_file_int = int(args.new_file is True)
     interactive_int = int(args.interactive is True)
     param_sum = get_acpass_int + new_org_int + delete_account_int + \
-                change_acpass_int + new_file_int + interactive_int
+                change_acpass_int + rotate_int + search_int + import_int + \
+                export_int + batch_int + rekey_int + agent_add_int + \
+                agent_lock_int + new_file_int + interactive_int
     if param_sum > 1:
         parser.print_help()
         raise RuntimeError("Error. Can only use one of these flags at a time")
@@ -220,6 +798,29 @@ def mainfunc():
         raise SystemExit("Error. Must use --file and "
                          "at least one additional flag")
 
+    if len(fnames) > 1:
+        if args.get_acpass is None and args.search is None:
+            raise RuntimeError("Error. Only -g and -s can use several files")
+        if multi_get:
+            raise RuntimeError("Error. -g takes one org with several files")
+        vault_set = open_vaults(fnames, not args.no_encrypt,
+                                backup=args.backup, journal=args.journal,
+                                layout=args.layout)
+        try:
+            if args.get_acpass is not None:
+                get_from_vaults(vault_set, args.get_acpass[0],
+                                args.print_to_screen)
+            else:
+                search_vaults(vault_set, args.search, args.limit)
+        finally:
+            vault_set.zeroize()
+        return
+
+    iterations = None
+    if args.kdf_target_ms is not None:
+        iterations = PwFile.calibrate_iterations(args.kdf_target_ms / 1000)
+        print("Using {} key derivation iterations".format(iterations))
+
     if args.new_file:
         # if file encrypted, new file requested & file already exists
         if os.path.isfile(fname):
@@ -230,68 +831,152 @@ def mainfunc():
             password = getpass.getpass(
             prompt="Enter password for file {}: ".format(fname))
         # negating no_encrypt to match semantics of 3rd param of create_new_file()
-        PwFile.create_new_file(fname, password, not args.no_encrypt)
+        PwFile.create_new_file(fname, password, not args.no_encrypt,
+                               iterations or DEFAULT_ITERATIONS,
+                               args.layout or 'single')
         print("New file created:", fname)
         return
 
+    if args.agent_add or args.agent_lock:
+        import agent
+
+        client = agent.connect()
+        if client is None:
+            raise RuntimeError("No agent running ({} is not set)".format(
+                agent.SOCKET_ENV))
+        if args.agent_lock:
+            client.lock(fname)
+            print("Agent no longer holds file:", fname)
+            return
+
+    if args.get_acpass is not None and not multi_get and get_from_agent(
+            fname, args.get_acpass[0], args.print_to_screen):
+        return
+
     if args.no_encrypt:
+        import _pickle
+
         password = None
         try:
-            pfile = PwFile(fname, password, not args.no_encrypt)
+            pfile = PwFile(fname, password, not args.no_encrypt,
+                           backup=args.backup, journal=args.journal,
+                           layout=args.layout)
         except _pickle.UnpicklingError as e:
             print("Error: could not open file. Are you sure this file is not "
                   "encrypted?")
             sys.exit(1)
     else:
+        from cryptography.fernet import InvalidToken
+
         while True:
             password = getpass.getpass(
                 prompt="Enter password for file {}: ".format(fname))
             # Create PwFile instance based on file name & password
             # negating no_encrypt to match semantics of 3rd param of PwFile constructor
             try:
-                pfile = PwFile(fname, password, not args.no_encrypt)
+                pfile = PwFile(fname, password, not args.no_encrypt,
+                               backup=args.backup, journal=args.journal,
+                               layout=args.layout)
                 break
-            except cryptography.fernet.InvalidToken as e:
+            except InvalidToken as e:
                 print("Error: incorrect file password. Please try again")
-            except UnicodeDecodeError as e:
+            except (UnicodeDecodeError, NotEncrypted) as e:
                 print("Error: Couldn't open file. Try running with "
                       "--no-encrypt")
                 sys.exit(1)
+            except CorruptFile as e:
+                print("Error: file {} is damaged: {}".format(fname, e))
+                sys.exit(1)
+
+    if args.agent_add:
+        client.add(fname, password, not args.no_encrypt)
+        print("File unlocked in agent:", fname)
+        return
+
+    if args.rekey:
+        pfile.rekey(iterations=iterations)
+        print("File re-encrypted with a new salt:", fname)
+        return
 
     if args.interactive is True:
         shell = PassShell(pfile)
         shell.cmdloop()
         return
 
-    if args.get_acpass is not None:
-        account = Account(pfile, args.get_acpass)
+    # lazy: a lookup in an indexed file reads only the account asked for
+    db = AccountDB(pfile, lazy=True)
+    if multi_get:
+        missing = get_many(db, selected, args.output or 'export',
+                           sys.stdout)
+        if missing:
+            print("No accounts matched:", " ".join(missing), file=sys.stderr)
+            sys.exit(1)
+    elif args.get_acpass is not None:
+        account = Account(db, args.get_acpass[0])
         account.get_password_from_file(args.print_to_screen)
         if args.print_to_screen is False:
             print("Password for account '{}' in paste buffer".format(
-                args.get_acpass))
+                args.get_acpass[0]))
     elif args.new_org is not None:
         if args.password_length < 1:
             raise RuntimeError("Error. Password length must be greater than 0.")
-        account = Account(pfile, args.new_org)
+        account = Account(db, args.new_org)
         print("Creating new account for:", args.new_org)
         acname = input("Enter username: ")
         account.create_new_account(acname, ALPHABET, args.password_length)
-        if args.set_acpass is not None:
+        if args.set_acpass:
             specified_pass = getpass.getpass(prompt="Enter password: ")
             account.set_acpass(specified_pass)
         print("Account created")
     elif args.delete_account is not None:
-        account = Account(pfile, args.delete_account)
+        account = Account(db, args.delete_account)
         account.delete_account()
         print("Deleted account for:", args.delete_account)
     elif args.change_acpass is not None:
-        account = Account(pfile, args.change_acpass)
-        if args.set_acpass is None:
-            account.set_acpass_rand(ALPHABET, args.password_length)
-        else:
+        account = Account(db, args.change_acpass)
+        if args.set_acpass:
             specified_pass = getpass.getpass(prompt="Enter password: ")
             account.set_acpass(specified_pass)
+        else:
+            account.set_acpass_rand(ALPHABET, args.password_length)
         print("Password changed for account:", args.change_acpass)
+    elif args.rotate is not None:
+        rotate_passwords(db, None if args.all else args.rotate, ALPHABET,
+                         args.password_length)
+    elif args.search is not None:
+        search_orgs(db, args.search, args.limit)
+    elif args.import_file is not None:
+        start = time.perf_counter()
+        count, invalid = transfer.import_records(db, args.import_file,
+                                                 args.format)
+        db.flush()
+        elapsed = time.perf_counter() - start
+        for line_num, reason in invalid:
+            print("Skipped line {}: {}".format(line_num, reason))
+        rate = (count + len(invalid)) / max(elapsed, 1e-9)
+        print("Imported {} account(s), skipped {} in {:.2f}s "
+              "({:.0f} records/s)".format(count, len(invalid), elapsed, rate))
+    elif args.batch is not None:
+        if args.batch == '-':
+            run, failed = run_batch(db, sys.stdin, sys.stdout,
+                                    args.commit_every)
+        else:
+            with open(args.batch) as script:
+                run, failed = run_batch(db, script, sys.stdout,
+                                        args.commit_every)
+        if failed:
+            print("{} of {} command(s) failed".format(failed, run),
+                  file=sys.stderr)
+            sys.exit(1)
+    elif args.export_file is not None:
+        start = time.perf_counter()
+        count = transfer.export_records(db, args.export_file, args.format)
+        elapsed = time.perf_counter() - start
+        rate = count / max(elapsed, 1e-9)
+        print("Exported {} account(s) to {} in {:.2f}s "
+              "({:.0f} records/s)".format(count, args.export_file, elapsed,
+                                          rate))
+    db.flush()
     return
 
 
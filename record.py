@@ -0,0 +1,8 @@
+"""
+Defines AccountRecord, the unit stored in a PwFile for each account
+"""
+from collections import namedtuple
+
+# What the file stores per account. Only the credential data is kept; older
+# files stored whole Account instances (see AccountDB.__init__)
+AccountRecord = namedtuple('AccountRecord', ['org', 'acname', 'acpassword'])
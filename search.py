@@ -0,0 +1,162 @@
+"""
+Search over org names: prefix, substring and fuzzy (typo-tolerant) matches,
+ranked in that order. Matching ignores case.
+
+OrgIndex is built once from a list of orgs and then answers queries (and
+completes org names) without scanning every org:
+- prefix matches come from a sorted list of case-folded orgs (bisect)
+- substring and fuzzy matches come from trigram posting lists: for each
+  three-letter sequence, the orgs containing it. Orgs are padded as in
+  PostgreSQL's pg_trgm ("  org "), so short orgs and word starts count too.
+  Substrings and fuzzy matches need a query of at least 3 letters.
+"""
+import bisect
+import heapq
+import itertools
+from collections import namedtuple
+
+# org: org name as stored; kind: 'exact', 'prefix', 'substring' or 'fuzzy';
+# score: trigram similarity (0..1] for fuzzy matches, 1.0 otherwise
+Match = namedtuple('Match', ['org', 'kind', 'score'])
+
+KINDS = ['exact', 'prefix', 'substring', 'fuzzy']
+# lowest trigram similarity (shared / all distinct trigrams) of a fuzzy match
+FUZZY_THRESHOLD = 0.3
+# trigrams in more than this share of orgs say little about which org is
+# meant and are skipped when collecting fuzzy candidates
+COMMON_TRIGRAM_SHARE = 0.01
+_LAST_CHAR = chr(0x10ffff)
+
+
+def _trigrams(text: str) -> set:
+    """
+    :param text: case-folded string
+    :return: set of trigrams of text padded with two spaces in front and
+    one behind
+    """
+    padded = "  " + text + " "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class OrgIndex:
+    '''
+    Search index over a fixed list of org names. Build a new one when the
+    orgs change
+    '''
+
+    def __init__(self, orgs) -> None:
+        """
+        :param orgs: iterable of org names
+        """
+        # shortest first, so that posting lists are in the order substring
+        # matches are ranked in and a search can stop at the first few
+        self.orgs = sorted(orgs, key=lambda org: (len(org), org.casefold()))
+        self._folded = [org.casefold() for org in self.orgs]
+        order = sorted(range(len(self.orgs)), key=self._folded.__getitem__)
+        # folded orgs in sorted order, and where each is in self.orgs
+        self._sorted = [self._folded[i] for i in order]
+        self._sorted_pos = order
+        # trigram -> positions (in self.orgs) of orgs that contain it. Built
+        # by the first search that needs it; completion and prefix searches
+        # don't
+        self._postings = None
+        self._common = max(100, int(len(self.orgs) * COMMON_TRIGRAM_SHARE))
+
+    def __len__(self) -> int:
+        return len(self.orgs)
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """
+        :param query: text to look for in org names (an empty query matches
+        every org)
+        :param limit: most matches to return; 0 or None for all
+        :return: list of Match, best first: exact, then prefix matches
+        (alphabetically), substring matches (shortest first) and fuzzy
+        matches (most similar first)
+        """
+        query = query.casefold()
+        limit = limit or len(self.orgs)
+        matches = []
+        found = set()
+
+        def add(pos, kind, score=1.0):
+            found.add(pos)
+            matches.append(Match(self.orgs[pos], kind, score))
+
+        for pos in itertools.islice(self._prefixed(query), limit):
+            add(pos, 'exact' if self._folded[pos] == query else 'prefix')
+        if len(query) < 3:
+            return matches
+        if self._postings is None:
+            self._postings = {}
+            for pos, folded in enumerate(self._folded):
+                for gram in _trigrams(folded):
+                    self._postings.setdefault(gram, []).append(pos)
+
+        if len(matches) < limit:
+            for pos in self._substrings(query, limit - len(matches), found):
+                add(pos, 'substring')
+        if len(matches) < limit:
+            for score, pos in self._fuzzy(query, limit - len(matches), found):
+                add(pos, 'fuzzy', score)
+        return matches
+
+    def complete(self, prefix: str) -> list:
+        """
+        :param prefix: start of an org name (any case)
+        :return: list of orgs starting with prefix, ignoring case,
+        alphabetically
+        """
+        return [self.orgs[pos] for pos in self._prefixed(prefix.casefold())]
+
+    def _prefixed(self, prefix: str):
+        """
+        :param prefix: case-folded start of an org name
+        :return: iterator over the positions of orgs starting with prefix,
+        alphabetically
+        """
+        start = bisect.bisect_left(self._sorted, prefix)
+        # every string starting with prefix sorts before this one
+        end = bisect.bisect_left(self._sorted, prefix + _LAST_CHAR, start)
+        return map(self._sorted_pos.__getitem__, range(start, end))
+
+    def _substrings(self, query: str, limit: int, exclude: set) -> list:
+        """
+        :return: positions of up to limit orgs (not in exclude) that contain
+        query, best first
+        """
+        grams = [query[i:i + 3] for i in range(len(query) - 2)]
+        postings = [self._postings.get(gram) for gram in grams]
+        if not all(postings):
+            return []
+        # every org containing query contains its rarest trigram
+        candidates = (pos for pos in min(postings, key=len)
+                      if pos not in exclude and query in self._folded[pos])
+        return list(itertools.islice(candidates, limit))
+
+    def _fuzzy(self, query: str, limit: int, exclude: set) -> list:
+        """
+        :return: list of (similarity, position) of up to limit orgs (not in
+        exclude) whose trigrams are similar enough to query's, best first
+        """
+        grams = _trigrams(query)
+        shared = {}
+        for gram in grams:
+            postings = self._postings.get(gram, ())
+            if len(postings) > self._common:
+                continue
+            for pos in postings:
+                shared[pos] = shared.get(pos, 0) + 1
+        # the exact similarity is only worked out for the likeliest orgs
+        likely = heapq.nlargest(4 * limit, shared.items(),
+                                key=lambda item: item[1])
+        scored = []
+        for pos, count in likely:
+            if pos in exclude:
+                continue
+            org_grams = _trigrams(self._folded[pos])
+            score = len(grams & org_grams) / len(grams | org_grams)
+            if score >= FUZZY_THRESHOLD:
+                scored.append((score, pos))
+        scored.sort(key=lambda item: (-item[0], self._folded[item[1]]))
+        return scored[:limit]
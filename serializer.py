@@ -0,0 +1,241 @@
+"""
+Serializers for the account data stored in a PwFile
+
+The default, BinarySerializer, writes a compact length-prefixed format:
+    MAGIC (3 bytes), schema version (1 byte), record count (uint32)
+    a table of 3 x count uint32 lengths, in characters, of each record's
+    org, acname and acpassword
+    all of those strings, joined with NUL characters and UTF-8 encoded
+All integers are big-endian. The text is decoded at once and split at the
+NULs in a single call; slicing it field by field at the lengths, as schema
+version 1 (still read, without the NULs) did, loaded slower than a pickle.
+The lengths check the split, and are used instead if a field holds a NUL.
+Journal changes use CHANGE_MAGIC, the schema version and an op byte,
+followed by the layout above for one record without its header (b'P', put)
+or by the UTF-8 org (b'D', delete).
+
+The index of an indexed PwFile (org -> where its record is in the file) uses
+INDEX_MAGIC, the schema version and the entry count, a table of (org length
+in characters, offset, length) per entry (uint32, uint64, uint32) and the
+UTF-8 orgs.
+
+Older files hold pickles. loads() detects the format, so they still open,
+and are converted the next time the file is written. Pickles are loaded
+with an unpickler that only accepts the classes ezpass itself stored.
+"""
+import array
+import io
+import itertools
+import pickle
+import struct
+import sys
+
+from record import AccountRecord
+
+MAGIC = b"EZR"
+CHANGE_MAGIC = b"EZC"
+INDEX_MAGIC = b"EZI"
+SCHEMA_VERSION = 2
+# between the fields of the text, from schema version 2 on
+_SEPARATOR = "\0"
+
+_HEADER = struct.Struct(">3sBI")
+_CHANGE_HEADER = struct.Struct(">3sBc")
+_INDEX_ENTRY = struct.Struct(">IQI")
+# array typecode of a 4-byte unsigned int
+_UINT32 = 'I' if array.array('I').itemsize == 4 else 'L'
+
+
+class BinarySerializer:
+    '''
+    Length-prefixed binary format (see module docstring)
+    '''
+    name = 'binary'
+
+    @staticmethod
+    def dumps(records: list) -> bytes:
+        """
+        :param records: list of AccountRecord instances
+        :return: serialized records (bytes)
+        """
+        fields = [field for record in records
+                  for field in (record.org, record.acname, record.acpassword)]
+        lengths = struct.pack(">{}I".format(len(fields)), *map(len, fields))
+        return _HEADER.pack(MAGIC, SCHEMA_VERSION, len(records)) + lengths + \
+            _SEPARATOR.join(fields).encode()
+
+    @staticmethod
+    def loads(data) -> list:
+        """
+        :param data: bytes-like object written by dumps()
+        :return: list of AccountRecord instances
+        """
+        magic, version, count = _HEADER.unpack_from(data, 0)
+        _check_version(magic, MAGIC, version)
+        # the lengths table and the blob are read through a memoryview, and
+        # the lengths kept in an array, so that decoding a large file makes
+        # no copies beyond the decoded text
+        text_start = _HEADER.size + 4 * 3 * count
+        lengths = array.array(_UINT32)
+        with memoryview(data) as view:
+            lengths.frombytes(view[_HEADER.size:text_start])
+            text = str(view[text_start:], 'utf-8')
+        if sys.byteorder == 'little':
+            lengths.byteswap()
+        gap = len(_SEPARATOR) if version >= 2 else 0
+        if sum(lengths) + gap * max(len(lengths) - 1, 0) != len(text):
+            raise ValueError("Record lengths don't match data")
+        fields = text.split(_SEPARATOR) if gap else []
+        if len(fields) != len(lengths):
+            # version 1, or a field holding the separator
+            starts = itertools.accumulate(
+                (length + gap for length in lengths), initial=0)
+            fields = [text[start:start + length]
+                      for start, length in zip(starts, lengths)]
+        fields = iter(fields)
+        # every item of the zip has three fields, so AccountRecord._make's
+        # length check is left out
+        return list(map(tuple.__new__, itertools.repeat(AccountRecord),
+                        zip(fields, fields, fields)))
+
+    @staticmethod
+    def dumps_change(change: tuple) -> bytes:
+        """
+        :param change: ('put', AccountRecord) or ('del', org)
+        :return: serialized change (bytes)
+        """
+        op, arg = change
+        if op == 'put':
+            record = BinarySerializer.dumps([arg])[_HEADER.size:]
+            return _CHANGE_HEADER.pack(CHANGE_MAGIC, SCHEMA_VERSION, b'P') + \
+                record
+        return _CHANGE_HEADER.pack(CHANGE_MAGIC, SCHEMA_VERSION, b'D') + \
+            arg.encode()
+
+    @staticmethod
+    def loads_change(data) -> tuple:
+        """
+        :param data: bytes-like object written by dumps_change()
+        :return: ('put', AccountRecord) or ('del', org)
+        """
+        magic, version, op = _CHANGE_HEADER.unpack_from(data, 0)
+        _check_version(magic, CHANGE_MAGIC, version)
+        body = bytes(data[_CHANGE_HEADER.size:])
+        if op == b'P':
+            header = _HEADER.pack(MAGIC, version, 1)
+            return 'put', BinarySerializer.loads(header + body)[0]
+        return 'del', str(body, 'utf-8')
+
+
+def dumps_index(entries: list) -> bytes:
+    """
+    :param entries: list of (org, offset, length) tuples
+    :return: serialized index (bytes)
+    """
+    parts = [_HEADER.pack(INDEX_MAGIC, SCHEMA_VERSION, len(entries))]
+    for org, offset, length in entries:
+        parts.append(_INDEX_ENTRY.pack(len(org), offset, length))
+    parts.append("".join(org for org, offset, length in entries).encode())
+    return b"".join(parts)
+
+
+def loads_index(data) -> dict:
+    """
+    :param data: bytes-like object written by dumps_index()
+    :return: dict of org -> (offset, length)
+    """
+    magic, version, count = _HEADER.unpack_from(data, 0)
+    _check_version(magic, INDEX_MAGIC, version)
+    table = [_INDEX_ENTRY.unpack_from(data, _HEADER.size + i * _INDEX_ENTRY.size)
+             for i in range(count)]
+    orgs = str(data[_HEADER.size + count * _INDEX_ENTRY.size:], 'utf-8')
+    index = {}
+    pos = 0
+    for org_len, offset, length in table:
+        index[orgs[pos:pos + org_len]] = (offset, length)
+        pos += org_len
+    return index
+
+
+class PickleSerializer:
+    '''
+    The format ezpass used before BinarySerializer. Kept for reading older
+    files and for comparison in bench_ezpass.py
+    '''
+    name = 'pickle'
+
+    @staticmethod
+    def dumps(records: list) -> bytes:
+        return pickle.dumps(records)
+
+    @staticmethod
+    def loads(data) -> list:
+        return _RestrictedUnpickler(io.BytesIO(data)).load()
+
+    @staticmethod
+    def dumps_change(change: tuple) -> bytes:
+        return pickle.dumps(change)
+
+    @staticmethod
+    def loads_change(data) -> tuple:
+        return _RestrictedUnpickler(io.BytesIO(data)).load()
+
+
+class _RestrictedUnpickler(pickle.Unpickler):
+    # classes found in pickles written by earlier versions of ezpass
+    allowed = {
+        ('record', 'AccountRecord'),
+        ('accountdb', 'AccountRecord'),
+        ('account', 'Account'),
+        ('pwfile', 'PwFile'),
+    }
+
+    def find_class(self, module, name):
+        if (module, name) not in self.allowed:
+            raise pickle.UnpicklingError(
+                "Refusing to load '{}.{}' from file".format(module, name))
+        return super().find_class(module, name)
+
+
+SERIALIZERS = {
+    BinarySerializer.name: BinarySerializer,
+    PickleSerializer.name: PickleSerializer,
+}
+DEFAULT = BinarySerializer
+
+
+def _check_version(magic, expected_magic, version):
+    if magic != expected_magic:
+        raise ValueError("Data is not in ezpass binary format")
+    if not 1 <= version <= SCHEMA_VERSION:
+        raise ValueError("Unsupported schema version {}".format(version))
+
+
+def is_legacy(data) -> bool:
+    """
+    :return: True if data is not in the binary format (i.e. a pickle)
+    """
+    return bytes(data[:len(MAGIC)]) != MAGIC
+
+
+def loads(data) -> list:
+    """
+    Loads records written by any of the serializers
+    :param data: bytes-like object
+    :return: list of AccountRecord (or, from very old files, Account)
+    instances
+    """
+    if is_legacy(data):
+        return PickleSerializer.loads(data)
+    return BinarySerializer.loads(data)
+
+
+def loads_change(data) -> tuple:
+    """
+    Loads a journal change written by any of the serializers
+    :param data: bytes-like object
+    :return: ('put', AccountRecord) or ('del', org)
+    """
+    if bytes(data[:len(CHANGE_MAGIC)]) != CHANGE_MAGIC:
+        return PickleSerializer.loads_change(data)
+    return BinarySerializer.loads_change(data)
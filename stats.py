@@ -0,0 +1,130 @@
+"""
+Opt-in timing and counters for the steps that reading and writing a password
+file spend their time in. Enabled by `ezpass.py --stats` and the `stats`
+command of the interactive shell; while disabled, timed() costs a function
+call and records nothing.
+
+Operations (bytes are those each step takes in, except where noted):
+    kdf           PBKDF2 key derivation
+    read          reading the file (and journal) from disk; a memory mapped
+                  file is read while it is hashed
+    decrypt       Fernet decryption (bytes: ciphertext)
+    deserialize   decoding records from bytes
+    serialize     encoding records to bytes (bytes: output)
+    encrypt       Fernet encryption (bytes: plaintext). For the 'indexed'
+                  layout and the journal this includes serializing each record
+    write         writing and fsyncing the file or journal
+    decrypt_file  all of PwFile._decryptFile (read, decrypt & for the
+                  'indexed' layout deserialize)
+    encrypt_file  all of PwFile._encryptFile / _encryptIndexed /
+                  _encryptChunked (encrypt & write)
+The last two include the time of the steps within them, so the column
+totals are not a sum of disjoint times.
+"""
+import contextlib
+import json
+import threading
+import time
+
+# version of the JSON report layout
+REPORT_VERSION = 1
+
+enabled = False
+_started = None
+_lock = threading.Lock()
+# operation -> [calls, seconds, bytes]
+_totals = {}
+
+
+class _Op:
+    '''
+    Handed out by timed(); set .bytes once the size is known
+    '''
+    __slots__ = ('bytes',)
+
+    def __init__(self, nbytes: int = 0) -> None:
+        self.bytes = nbytes
+
+
+def enable(on: bool = True) -> None:
+    """
+    Starts (or stops) collecting, keeping what was collected so far
+    :return: None
+    """
+    global enabled, _started
+    if on and _started is None:
+        _started = time.perf_counter()
+    enabled = on
+    return
+
+
+def reset() -> None:
+    """
+    Drops everything collected so far
+    :return: None
+    """
+    global _started
+    with _lock:
+        _totals.clear()
+        _started = time.perf_counter() if enabled else None
+    return
+
+
+@contextlib.contextmanager
+def timed(name: str, nbytes: int = 0):
+    """
+    Times the body of a with block as one call of operation name
+    :param name: operation (see module docstring)
+    :param nbytes: bytes processed, if known up front
+    :return: context manager giving an object whose .bytes can be set in
+    the block
+    """
+    op = _Op(nbytes)
+    if not enabled:
+        yield op
+        return
+    start = time.perf_counter()
+    try:
+        yield op
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            total = _totals.setdefault(name, [0, 0.0, 0])
+            total[0] += 1
+            total[1] += elapsed
+            total[2] += op.bytes
+
+
+def snapshot() -> dict:
+    """
+    :return: dict with "version" (REPORT_VERSION), "seconds" (time since
+    collecting started) and "operations": operation -> dict of "calls",
+    "seconds" and "bytes"
+    """
+    with _lock:
+        operations = {name: {"calls": calls, "seconds": seconds,
+                             "bytes": nbytes}
+                      for name, (calls, seconds, nbytes) in _totals.items()}
+    elapsed = 0.0 if _started is None else time.perf_counter() - _started
+    return {"version": REPORT_VERSION, "seconds": elapsed,
+            "operations": operations}
+
+
+def to_json() -> str:
+    return json.dumps(snapshot(), sort_keys=True)
+
+
+def format_report() -> str:
+    """
+    :return: snapshot() as a table, slowest operation first
+    """
+    report = snapshot()
+    lines = ["{:<14} {:>7} {:>11} {:>14}".format(
+        "operation", "calls", "time (ms)", "bytes")]
+    for name, op in sorted(report["operations"].items(),
+                           key=lambda item: -item[1]["seconds"]):
+        lines.append("{:<14} {:>7} {:>11.2f} {:>14}".format(
+            name, op["calls"], op["seconds"] * 1000, op["bytes"]))
+    lines.append("{:<14} {:>7} {:>11.2f}".format(
+        "total", "", report["seconds"] * 1000))
+    return "\n".join(lines)
@@ -5,12 +5,34 @@ import _pickle
 
 import cryptography
 
+import agent
+import asyncvault
 import ezpass
+import pwfile as pwfile_module
+import serializer
+import stats
+import transfer
+import vaults
+from accountdb import AccountRecord
 
 import unittest
 import pyperclip
+import asyncio
 import random
+import glob
+import io
+import json
+import multiprocessing
+import netrc
 import os
+import pickle
+import readline
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
 
 fname = "test_file.csv"
 FILE_PASSWORD = "hello"
@@ -20,6 +42,27 @@ password_length = 2 * len(ezpass.ALPHABET)
 specified_pass = "myn3wpass"
 pwfile = None
 acname = "some@gmail.com"
+# modules that only some commands need, so must not be imported up front
+# ('bench_ezpass.py import' times the import itself)
+DEFERRED_IMPORTS = ["cryptography", "pyperclip", "readline", "pprint", "agent",
+                    "vaults"]
+
+
+def _parallel_writer(fname2, i):
+    """
+    One of the processes of test_parallel_writers_lose_no_updates. Adds its
+    own account and sets the password of the shared one, by a full rewrite,
+    through the journal, or through a journal that is compacted every few
+    writes
+    """
+    mode = i % 3
+    pwfile2 = ezpass.PwFile(fname2, FILE_PASSWORD, True, journal=mode > 0,
+                            journal_limit=1024 if mode == 2 else 1 << 20)
+    db = ezpass.AccountDB(pwfile2)
+    ezpass.Account(db, "org{}".format(i)).create_new_account(
+        acname, test_alphabet, 8)
+    db.set_password("Shared", "pass{}".format(i))
+    db.flush()
 
 
 class Tests(unittest.TestCase):
@@ -56,8 +99,15 @@ class Tests(unittest.TestCase):
         if not os.path.isfile(fname):
             raise RuntimeError("Error: File {} does not exist.".format(fname))
         os.remove(fname)
+        os.remove(fname + ".lock")
         print("Tests tearDown: end")
 
+    def tearDown(self) -> None:
+        # lock files (see PwFile.lock) outlive the files the tests remove
+        for lock_fname in glob.glob("*.lock"):
+            if not os.path.isfile(lock_fname[:-len(".lock")]):
+                os.remove(lock_fname)
+
     def create_random_fname(self):
         length = random.randint(3, 10)
         random_fname = ""
@@ -116,6 +166,18 @@ class Tests(unittest.TestCase):
         for letter in password:
             self.assertIn(letter, ezpass.ALPHABET)
 
+    def test_create_passwords(self):
+        passwords = ezpass.create_passwords("abc", 5, 100)
+        self.assertEqual(len(passwords), 100)
+        for password in passwords:
+            self.assertEqual(len(password), 5)
+        self.assertEqual(set("".join(passwords)), set("abc"))
+        # letters that don't fit in a byte
+        for password in ezpass.create_passwords("\u00e9\u2603", 4, 3):
+            self.assertEqual(len(password), 4)
+            for letter in password:
+                self.assertIn(letter, "\u00e9\u2603")
+
     def test_check_if_account_exists_existing_acct(self):
         pwfile = ezpass.PwFile(fname, FILE_PASSWORD, True)
         account = ezpass.Account(pwfile, 'Twitter')
@@ -233,6 +295,1051 @@ class Tests(unittest.TestCase):
         except RuntimeError as err:
             pass
 
+    def test_key_derived_once_per_pwfile(self):
+        pwfile = ezpass.PwFile(fname, FILE_PASSWORD, True)
+        before = ezpass.PwFile.kdf_count
+        account = ezpass.Account(pwfile, "Kdfcount")
+        account.create_new_account(acname, test_alphabet, password_length)
+        account.delete_account()
+        self.assertEqual(ezpass.PwFile.kdf_count, before)
+
+    def test_zeroize_clears_key(self):
+        pwfile = ezpass.PwFile(fname, FILE_PASSWORD, True)
+        key = pwfile._key
+        pwfile.zeroize()
+        self.assertEqual(key, bytearray(len(key)))
+        try:
+            pwfile.readFile()
+            self.fail("Did not raise expected error")
+        except RuntimeError as err:
+            pass
+
+    def test_accountdb_writes_on_flush(self):
+        db = ezpass.AccountDB(ezpass.PwFile(fname, FILE_PASSWORD, True))
+        account = ezpass.Account(db, "Sessionorg")
+        account.create_new_account(acname, test_alphabet, password_length)
+        self.assertEqual(db.dirty, True)
+        self.assertEqual(db.has("Sessionorg"), True)
+        ondisk = ezpass.Account(pwfile, "Sessionorg")
+        self.assertEqual(ondisk.check_if_org_exists(), False)
+        db.flush()
+        self.assertEqual(db.dirty, False)
+        ondisk = ezpass.Account(pwfile, "Sessionorg")
+        self.assertEqual(ondisk.check_if_org_exists(), True)
+        ondisk.delete_account()
+
+    def test_accountdb_find_ignore_case(self):
+        db = ezpass.AccountDB(ezpass.PwFile(fname, FILE_PASSWORD, True))
+        self.assertIsNone(db.find("twitter"))
+        self.assertEqual(db.find("twitter", ignore_case=True).org, "Twitter")
+        db.remove("Twitter")
+        self.assertIsNone(db.find("twitter", ignore_case=True))
+        self.assertEqual(db.has("Twitter"), False)
+
+    def test_accountdb_migrates_legacy_accounts(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, None, False)
+        legacy_file = ezpass.PwFile(fname2, None, False,
+                                    serializer=serializer.PickleSerializer)
+        # laid out as PwFile and Account were when files held Account objects
+        legacy_pwfile = ezpass.PwFile.__new__(ezpass.PwFile)
+        legacy_pwfile.__dict__.update(fname=fname2, fpass=None, encrypt=False)
+        legacy = ezpass.Account.__new__(ezpass.Account)
+        legacy.__dict__.update(pwfile=legacy_pwfile, org="Legacy",
+                               acname=acname, acpassword=specified_pass)
+        legacy_file.writeFile([legacy])
+
+        db = ezpass.AccountDB(ezpass.PwFile(fname2, None, False))
+        self.assertEqual(db.dirty, True)
+        self.assertEqual(db.find("Legacy"),
+                         AccountRecord("Legacy", acname, specified_pass))
+        db.flush()
+        self.assertEqual(ezpass.PwFile(fname2, None, False).readFile(),
+                         [AccountRecord("Legacy", acname, specified_pass)])
+        os.remove(fname2)
+
+    def test_accountdb_select(self):
+        db = ezpass.AccountDB(ezpass.PwFile(fname, FILE_PASSWORD, True))
+        orgs, missing = db.select(["Gmail", "P*", "Nothere", "x*"])
+        self.assertEqual(orgs, ["Gmail", "Pinterest"])
+        self.assertEqual(missing, ["Nothere", "x*"])
+        orgs, missing = db.select(None)
+        self.assertEqual(orgs, db.orgs())
+        self.assertEqual(missing, [])
+        # 'all' is an org name like any other
+        self.assertEqual(db.select(["all"]), ([], ["all"]))
+        db.add(AccountRecord("all", acname, specified_pass))
+        self.assertEqual(db.select(["all"]), (["all"], []))
+
+    def test_accountdb_rotate(self):
+        db = ezpass.AccountDB(ezpass.PwFile(fname, FILE_PASSWORD, True))
+        before = {org: db.find(org).acpassword for org in db.orgs()}
+        db.rotate(["Twitter", "Gmail"], test_alphabet, password_length)
+        self.assertEqual(db.dirty, True)
+        for org in ["Twitter", "Gmail"]:
+            self.assertNotEqual(db.find(org).acpassword, before[org])
+            self.assertEqual(len(db.find(org).acpassword), password_length)
+        self.assertEqual(db.find("Pinterest").acpassword, before["Pinterest"])
+
+    def test_accountdb_search(self):
+        db = ezpass.AccountDB(ezpass.PwFile(fname, FILE_PASSWORD, True))
+        for org in ["GitHub", "gitlab", "Bank of America"]:
+            db.add(AccountRecord(org, acname, specified_pass))
+        self.assertEqual(db.search("github"), [("GitHub", "exact", 1.0)])
+        self.assertEqual([(m.org, m.kind) for m in db.search("GIT")],
+                         [("GitHub", "prefix"), ("gitlab", "prefix")])
+        self.assertEqual([(m.org, m.kind) for m in db.search("america")],
+                         [("Bank of America", "substring")])
+        matches = db.search("githb")
+        self.assertEqual([(m.org, m.kind) for m in matches],
+                         [("GitHub", "fuzzy"), ("gitlab", "fuzzy")])
+        self.assertGreater(matches[0].score, matches[1].score)
+        self.assertEqual(db.search("zzzz"), [])
+        self.assertEqual(len(db.search("", limit=2)), 2)
+        self.assertEqual(len(db.search("", limit=0)), len(db))
+        # the index follows the session's changes
+        db.remove("GitHub")
+        db.add(AccountRecord("Gitea", acname, specified_pass))
+        self.assertEqual([m.org for m in db.search("git")],
+                         ["Gitea", "gitlab"])
+
+    def test_shell_completes_org_names(self):
+        fname2 = self.get_non_existing_fname()
+        pwfile2 = ezpass.PwFile.create_new_file(fname2, None, False)
+        pwfile2.writeFile([AccountRecord(org, acname, specified_pass)
+                           for org in ["Twitter", "Gmail", "Pinterest"]])
+        shell = ezpass.PassShell(pwfile2)
+        self.assertEqual(shell.complete_g("t", "g -o t", 5, 6), ["Twitter"])
+        self.assertEqual(shell.complete_d("", "d -o ", 5, 5),
+                         ["Gmail", "Pinterest", "Twitter"])
+        # only the value of -o is an org
+        self.assertEqual(shell.complete_ch("", "ch -o Gmail -p ", 15, 15), [])
+        self.assertEqual(shell.complete_rot("p", "rot -o Gmail p", 13, 14),
+                         ["Pinterest"])
+        shell.db.add(AccountRecord("Tumblr", acname, specified_pass))
+        self.assertEqual(shell.complete_g("T", "g -o T", 5, 6),
+                         ["Tumblr", "Twitter"])
+        # readline hands over the whole hyphenated name
+        self.assertNotIn("-", readline.get_completer_delims())
+        shell.db.add(AccountRecord("aws-prod", acname, specified_pass))
+        self.assertEqual(shell.complete_g("aws-p", "g -o aws-p", 5, 10),
+                         ["aws-prod"])
+        os.remove(fname2)
+
+    def test_vaults_unlock_and_federated_lookup(self):
+        fnames = [self.get_non_existing_fname() for i in range(2)]
+        while fnames[0] == fnames[1]:
+            fnames[1] = self.get_non_existing_fname()
+        for fname2, org in zip(fnames, ["Prod", "Staging"]):
+            db = ezpass.AccountDB(ezpass.PwFile.create_new_file(
+                fname2, FILE_PASSWORD + fname2, True))
+            for org2 in ["Shared", org]:
+                db.add(AccountRecord(org2, acname, org2 + fname2))
+            db.flush()
+
+        pwfiles, errors = vaults.unlock(
+            fnames, [FILE_PASSWORD + fnames[0], "wrong"], True)
+        self.assertEqual(list(pwfiles), fnames[:1])
+        self.assertIsInstance(errors[fnames[1]],
+                              cryptography.fernet.InvalidToken)
+        pwfiles, errors = vaults.unlock(
+            fnames, [FILE_PASSWORD + fname2 for fname2 in fnames], True)
+        self.assertEqual(errors, {})
+        vault_set = vaults.Vaults([pwfiles[fname2] for fname2 in fnames])
+        self.assertEqual(vault_set.find("Shared"), [
+            (fname2, AccountRecord("Shared", acname, "Shared" + fname2))
+            for fname2 in fnames])
+        self.assertEqual(vault_set.find("Staging"), [
+            (fnames[1], AccountRecord("Staging", acname,
+                                      "Staging" + fnames[1]))])
+        self.assertEqual(vault_set.find("Dev"), [])
+        self.assertEqual(
+            [(source, match.org, match.kind)
+             for source, match in vault_set.search("s")],
+            [(fnames[0], "Shared", "prefix"), (fnames[1], "Shared", "prefix"),
+             (fnames[1], "Staging", "prefix")])
+        vault_set.zeroize()
+        for fname2 in fnames:
+            os.remove(fname2)
+
+    def test_stats_time_file_operations(self):
+        stats.enable()
+        stats.reset()
+        try:
+            pwfile2 = ezpass.PwFile(fname, FILE_PASSWORD, True)
+            pwfile2.writeFile(pwfile2.readFile())
+            report = json.loads(stats.to_json())
+        finally:
+            stats.enable(False)
+            stats.reset()
+        operations = report["operations"]
+        self.assertEqual(set(operations), {
+            "kdf", "read", "decrypt", "deserialize", "serialize", "encrypt",
+            "write", "decrypt_file", "encrypt_file"})
+        self.assertEqual(operations["kdf"]["calls"], 1)
+        size = os.path.getsize(fname)
+        self.assertEqual(operations["write"]["bytes"], size)
+        self.assertEqual(operations["decrypt_file"]["calls"], 1)
+        self.assertGreater(report["seconds"],
+                           operations["kdf"]["seconds"])
+        # nothing is recorded while disabled
+        ezpass.PwFile(fname, FILE_PASSWORD, True)
+        self.assertEqual(stats.snapshot()["operations"], {})
+
+    def test_export_import_round_trip(self):
+        db = ezpass.AccountDB(ezpass.PwFile(fname, FILE_PASSWORD, True))
+        for fmt in transfer.FORMATS:
+            export_fname = self.get_non_existing_fname() + "." + fmt
+            count = transfer.export_records(db, export_fname)
+            self.assertEqual(count, len(db))
+            fname2 = self.get_non_existing_fname()
+            db2 = ezpass.AccountDB(
+                ezpass.PwFile.create_new_file(fname2, None, False))
+            count, invalid = transfer.import_records(db2, export_fname)
+            self.assertEqual((count, invalid), (len(db), []))
+            self.assertEqual(db2.accounts, db.accounts)
+            # importing again rejects every row as a duplicate
+            count, invalid = transfer.import_records(db2, export_fname)
+            self.assertEqual(count, 0)
+            self.assertEqual(len(invalid), len(db))
+            os.remove(export_fname)
+            os.remove(fname2)
+
+    def test_import_reports_invalid_rows(self):
+        import_fname = self.get_non_existing_fname() + ".jsonl"
+        with open(import_fname, "w") as file:
+            file.write('{"org": "Good", "username": "u", "password": "p"}\n')
+            file.write('{"org": "Bad org", "username": "u", "password": "p"}\n')
+            file.write('{"org": "Nopass", "username": "u"}\n')
+            file.write('not json\n')
+        fname2 = self.get_non_existing_fname()
+        db = ezpass.AccountDB(
+            ezpass.PwFile.create_new_file(fname2, None, False))
+        count, invalid = transfer.import_records(db, import_fname)
+        self.assertEqual(count, 1)
+        self.assertEqual([line_num for line_num, reason in invalid], [2, 3, 4])
+        self.assertEqual(db.orgs(), ["Good"])
+        os.remove(import_fname)
+        os.remove(fname2)
+
+    def test_batch_runs_script_with_one_write(self):
+        fname2 = self.get_non_existing_fname()
+        pwfile2 = ezpass.PwFile.create_new_file(fname2, None, False)
+        script = [
+            "# comment",
+            "n -o Gmail -u alice --password secret",
+            '{"cmd": "n", "org-name": "Twitter", "username": "bob", '
+            '"pw-length": 12}',
+            "",
+            "ch -o Gmail -l 10",
+            "g -o Nope",
+            "g -o",
+            "x -o Gmail",
+            '{"cmd": "d", "args": ["-o", "Twitter"]}',
+            "n -o Gmail -u alice",
+            "n -o Tumblr -u carol -p",
+        ]
+        out = io.StringIO()
+        stats.enable()
+        stats.reset()
+        run, failed = ezpass.run_batch(ezpass.AccountDB(pwfile2), script, out)
+        writes = stats.snapshot()["operations"]["write"]["calls"]
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual((run, failed), (9, 5))
+        self.assertEqual([result["line"] for result in results],
+                         [2, 3, 5, 6, 7, 8, 9, 10, 11])
+        self.assertEqual([result["ok"] for result in results],
+                         [True, True, True, False, False, False, True,
+                          False, False])
+        self.assertEqual(results[0]["password"], "secret")
+        self.assertEqual(len(results[1]["password"]), 12)
+        self.assertEqual(len(results[2]["password"]), 10)
+        self.assertIn("not in file", results[3]["error"])
+        self.assertIn("already exists", results[7]["error"])
+        # all changes in one write
+        self.assertEqual(writes, 1)
+        db = ezpass.AccountDB(ezpass.PwFile(fname2, None, False))
+        self.assertEqual(db.accounts, [AccountRecord(
+            "Gmail", "alice", results[2]["password"])])
+
+        # per 2 changes
+        stats.reset()
+        ezpass.run_batch(ezpass.AccountDB(pwfile2),
+                         ["n -o A{} -u u".format(i) for i in range(5)],
+                         io.StringIO(), commit_every=2)
+        self.assertEqual(stats.snapshot()["operations"]["write"]["calls"], 3)
+        stats.enable(False)
+        stats.reset()
+
+        # malformed lines and rejected passwords fail alone and change nothing
+        out = io.StringIO()
+        run, failed = ezpass.run_batch(ezpass.AccountDB(pwfile2), [
+            "n -o B1 -u u --password x",
+            "g -o 'oops",
+            '{"cmd": "g", "args": 5}',
+            "n -o B2 -u u --password 'a b'",
+            "n -o B3 -u u",
+            "g -o B1 -h",
+        ], out)
+        self.assertEqual((run, failed), (6, 4))
+        self.assertIn("Invalid command line", out.getvalue())
+        # -h is an error record too, not a usage message
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(results), 6)
+        self.assertFalse(results[-1]["ok"])
+        self.assertIn("-h", results[-1]["error"])
+        db = ezpass.AccountDB(ezpass.PwFile(fname2, None, False))
+        self.assertEqual([org for org in db.orgs() if org.startswith("B")],
+                         ["B1", "B3"])
+        os.remove(fname2)
+
+    def test_cli_prompts_for_password_only_with_set_acpass(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, None, False)
+        # runs mainfunc with the given flags, answering the username prompt
+        # and, if it is asked for, the password prompt
+        script = (
+            "import builtins, getpass, sys, ezpass\n"
+            "prompts = []\n"
+            "def ask(prompt=''):\n"
+            "    prompts.append(prompt)\n"
+            "    return 'typed-pass'\n"
+            "builtins.input = ask\n"
+            "getpass.getpass = ask\n"
+            "sys.argv[:1] = ['ezpass', '-f', {!r}, '--no-encrypt']\n"
+            "ezpass.mainfunc()\n"
+            "print(len(prompts))\n"
+        ).format(fname2)
+
+        def run(*flags):
+            result = subprocess.run([sys.executable, "-c", script] +
+                                    list(flags), capture_output=True,
+                                    text=True, check=True)
+            return int(result.stdout.split()[-1])
+
+        def password(org):
+            return ezpass.AccountDB(ezpass.PwFile(fname2, None, False)).find(
+                org).acpassword
+
+        # username only
+        self.assertEqual(run("-no", "Gmail"), 1)
+        self.assertNotEqual(password("Gmail"), "typed-pass")
+        self.assertEqual(run("-no", "Twitter", "-sp"), 2)
+        self.assertEqual(password("Twitter"), "typed-pass")
+        self.assertEqual(run("-cp", "Twitter"), 0)
+        self.assertNotEqual(password("Twitter"), "typed-pass")
+        self.assertEqual(run("-cp", "Gmail", "-sp"), 1)
+        self.assertEqual(password("Gmail"), "typed-pass")
+        os.remove(fname2)
+
+    def test_cli_all_flag(self):
+        fname2 = self.get_non_existing_fname()
+        pwfile2 = ezpass.PwFile.create_new_file(fname2, None, False)
+        pwfile2.writeFile([AccountRecord("all", "u1", "p1"),
+                           AccountRecord("Gmail", "u2", "p2")])
+
+        def run(*flags):
+            return subprocess.run(
+                [sys.executable, "ezpass.py", "-f", fname2, "--no-encrypt"] +
+                list(flags), capture_output=True, text=True)
+
+        result = run("-g", "--all", "--output", "json")
+        self.assertEqual(sorted(json.loads(result.stdout)), ["Gmail", "all"])
+        result = run("-g", "all", "--output", "json")
+        self.assertEqual(list(json.loads(result.stdout)), ["all"])
+        for flags in [["-g"], ["-g", "Gmail", "--all"], ["-rot"],
+                      ["-s", "x", "--all"]]:
+            self.assertNotEqual(run(*flags).returncode, 0)
+        self.assertEqual(run("-rot", "--all").returncode, 0)
+        self.assertEqual([account.acpassword == password for account, password
+                          in zip(ezpass.PwFile(fname2, None, False).readFile(),
+                                 ["p1", "p2"])], [False, False])
+        os.remove(fname2)
+
+    def test_get_many_formats(self):
+        fname2 = self.get_non_existing_fname()
+        pwfile2 = ezpass.PwFile.create_new_file(fname2, None, False)
+        pwfile2.writeFile([AccountRecord("aws-prod", "ci", "pa$s"),
+                           AccountRecord("aws-dev", "dev", "p2"),
+                           AccountRecord("Gmail", acname, specified_pass)])
+        db = ezpass.AccountDB(pwfile2)
+        out = io.StringIO()
+        missing = ezpass.get_many(db, ["aws-*", "Nope", "Gmail", "x*"],
+                                  "export", out)
+        self.assertEqual(missing, ["Nope", "x*"])
+        self.assertEqual(out.getvalue(), (
+            "export AWS_PROD_USERNAME=ci\n"
+            "export AWS_PROD_PASSWORD='pa$s'\n"
+            "export AWS_DEV_USERNAME=dev\n"
+            "export AWS_DEV_PASSWORD=p2\n"
+            "export GMAIL_USERNAME={}\n"
+            "export GMAIL_PASSWORD={}\n").format(acname, specified_pass))
+        out = io.StringIO()
+        ezpass.get_many(db, None, "json", out)
+        self.assertEqual(json.loads(out.getvalue())["aws-dev"],
+                         {"username": "dev", "password": "p2"})
+        out = io.StringIO()
+        ezpass.get_many(db, ["aws-dev"], "netrc", out)
+        self.assertEqual(out.getvalue(),
+                         "machine aws-dev\n  login dev\n  password p2\n")
+        # netrc tokens are quoted and escaped where needed
+        awkward = [AccountRecord("quote", "u", '"abc#d'),
+                   AccountRecord("tab", "a\tb", "p\\q"),
+                   AccountRecord("#hash", "#u", "#p"),
+                   AccountRecord("plain", "login", "machine")]
+        netrc_fname = self.get_non_existing_fname()
+        with open(netrc_fname, "w") as file:
+            file.write(transfer.format_credentials(awkward, "netrc"))
+        hosts = netrc.netrc(netrc_fname).hosts
+        self.assertEqual(hosts, {account.org: (account.acname, '',
+                                               account.acpassword)
+                                 for account in awkward})
+        os.remove(netrc_fname)
+        with self.assertRaises(RuntimeError):
+            transfer.format_credentials(
+                [AccountRecord("nl", "u", "a\nb")], "netrc")
+        self.assertTrue(ezpass.is_multi_get(["aws-*"], None))
+        self.assertTrue(ezpass.is_multi_get(None, None))
+        self.assertFalse(ezpass.is_multi_get(["all"], None))
+        self.assertFalse(ezpass.is_multi_get(["Gmail"], None))
+        os.remove(fname2)
+
+    def test_async_vault_coalesces_loads(self):
+        fname2 = self.get_non_existing_fname()
+        db = ezpass.AccountDB(ezpass.PwFile.create_new_file(
+            fname2, FILE_PASSWORD, True))
+        for i in range(20):
+            db.add(AccountRecord("org{}".format(i), acname, specified_pass))
+        db.flush()
+
+        async def run():
+            vault = asyncvault.AsyncVault(fname2, FILE_PASSWORD, True)
+            found = await asyncio.gather(*[
+                vault.find("org{}".format(i % 25)) for i in range(100)])
+            # changes are written one at a time
+            await asyncio.gather(*[
+                vault.set_password("org{}".format(i), str(i))
+                for i in range(10)])
+            await vault.create_account("new", acname, "newpass")
+            with self.assertRaises(RuntimeError):
+                await vault.delete_account("missing")
+            with self.assertRaises(RuntimeError):
+                await vault.create_account("rejected", acname, "a b")
+            await vault.close()
+            return found
+
+        stats.enable()
+        stats.reset()
+        try:
+            found = asyncio.run(run())
+            operations = stats.snapshot()["operations"]
+        finally:
+            stats.enable(False)
+            stats.reset()
+        self.assertEqual(operations["kdf"]["calls"], 1)
+        self.assertEqual(operations["decrypt_file"]["calls"], 1)
+        self.assertEqual(operations["encrypt_file"]["calls"], 11)
+        self.assertEqual([account is None for account in found],
+                         [i % 25 >= 20 for i in range(100)])
+        db = ezpass.AccountDB(ezpass.PwFile(fname2, FILE_PASSWORD, True))
+        self.assertEqual(db.find("org3").acpassword, "3")
+        self.assertEqual(db.find("new").acpassword, "newpass")
+        self.assertEqual(len(db), 21)
+        self.assertIsNone(db.find("rejected"))
+        os.remove(fname2)
+
+    def test_write_killed_midway_keeps_file(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, FILE_PASSWORD, True)
+        ezpass.Account(ezpass.PwFile(fname2, FILE_PASSWORD, True),
+                       "Kept").create_new_account(acname, test_alphabet, 8)
+        with open(fname2, "rb") as file:
+            before = file.read()
+        # the child process is killed after writing the new contents but
+        # before they replace the file
+        script = (
+            "import os, signal, ezpass\n"
+            "pwfile = ezpass.PwFile({!r}, {!r}, True)\n"
+            "os.fsync = lambda fd: os.kill(os.getpid(), signal.SIGKILL)\n"
+            "pwfile.writeFile([])\n"
+        ).format(fname2, FILE_PASSWORD)
+        ret = subprocess.run([sys.executable, "-c", script])
+        self.assertNotEqual(ret.returncode, 0)
+        with open(fname2, "rb") as file:
+            self.assertEqual(file.read(), before)
+        account = ezpass.Account(ezpass.PwFile(fname2, FILE_PASSWORD, True),
+                                 "Kept")
+        self.assertEqual(account.check_if_org_exists(), True)
+        os.remove(fname2)
+        for leftover in os.listdir("."):
+            if leftover.startswith("." + fname2 + "."):
+                os.remove(leftover)
+
+    def test_write_keeps_backup(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, None, False)
+        pwfile2 = ezpass.PwFile(fname2, None, False, backup=True)
+        ezpass.Account(pwfile2, "First").create_new_account(
+            acname, test_alphabet, 8)
+        ezpass.Account(pwfile2, "Second").create_new_account(
+            acname, test_alphabet, 8)
+        self.assertEqual(ezpass.AccountDB(pwfile2).orgs(), ["First", "Second"])
+        backup = ezpass.PwFile(fname2 + ".bak", None, False)
+        self.assertEqual(ezpass.AccountDB(backup).orgs(), ["First"])
+        os.remove(fname2)
+        os.remove(fname2 + ".bak")
+
+    def test_journal_appends_and_replays(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, FILE_PASSWORD, True)
+        pwfile2 = ezpass.PwFile(fname2, FILE_PASSWORD, True, journal=True)
+        journal_fname = pwfile2.get_journal_fname()
+        db = ezpass.AccountDB(pwfile2)
+        for org in ["One", "Two", "Three"]:
+            ezpass.Account(db, org).create_new_account(acname, test_alphabet, 8)
+        db.flush()
+        with open(fname2, "rb") as file:
+            snapshot = file.read()
+        db.set_password("Two", specified_pass)
+        db.remove("Three")
+        db.flush()
+        with open(fname2, "rb") as file:
+            self.assertEqual(file.read(), snapshot)
+        self.assertEqual(os.path.isfile(journal_fname), True)
+
+        db2 = ezpass.AccountDB(ezpass.PwFile(fname2, FILE_PASSWORD, True))
+        self.assertEqual(db2.orgs(), ["One", "Two"])
+        self.assertEqual(db2.find("Two").acpassword, specified_pass)
+        # a full write folds the journal into the file
+        db2.set_password("One", specified_pass)
+        db2.flush()
+        self.assertEqual(os.path.isfile(journal_fname), False)
+        db3 = ezpass.AccountDB(ezpass.PwFile(fname2, FILE_PASSWORD, True))
+        self.assertEqual(db3.find("One").acpassword, specified_pass)
+        os.remove(fname2)
+
+    def test_journal_compacts_when_full(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, None, False)
+        pwfile2 = ezpass.PwFile(fname2, None, False, journal=True,
+                                journal_limit=200)
+        for i in range(10):
+            ezpass.Account(pwfile2, "Org{}".format(i)).create_new_account(
+                acname, test_alphabet, 8)
+            self.assertLessEqual(
+                os.path.getsize(fname2 + ".journal")
+                if os.path.isfile(fname2 + ".journal") else 0, 400)
+        db = ezpass.AccountDB(ezpass.PwFile(fname2, None, False))
+        self.assertEqual(len(db), 10)
+        os.remove(fname2)
+        if os.path.isfile(fname2 + ".journal"):
+            os.remove(fname2 + ".journal")
+
+    def test_journal_ignores_torn_and_stale_frames(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, None, False)
+        pwfile2 = ezpass.PwFile(fname2, None, False, journal=True)
+        ezpass.Account(pwfile2, "Kept").create_new_account(
+            acname, test_alphabet, 8)
+        # crash during an append
+        with open(fname2 + ".journal", "ab") as journal_file:
+            journal_file.write(b"\x00\x00\x01\x00partial")
+        ezpass.Account(pwfile2, "After").create_new_account(
+            acname, test_alphabet, 8)
+        db = ezpass.AccountDB(ezpass.PwFile(fname2, None, False))
+        self.assertEqual(db.orgs(), ["Kept", "After"])
+        # crash after compaction, before the journal was removed
+        with open(fname2 + ".journal", "rb") as journal_file:
+            stale = journal_file.read()
+        db.remove("Kept")
+        db.flush()
+        with open(fname2 + ".journal", "wb") as journal_file:
+            journal_file.write(stale)
+        db = ezpass.AccountDB(ezpass.PwFile(fname2, None, False))
+        self.assertEqual(db.orgs(), ["After"])
+        os.remove(fname2)
+        os.remove(fname2 + ".journal")
+
+    def test_open_legacy_file_without_header(self):
+        fname2 = self.get_non_existing_fname()
+        key = ezpass.PwFile._derive_key(FILE_PASSWORD, pwfile_module.LEGACY_KDF)
+        token = ezpass.PwFile._fernet(key).encrypt(pickle.dumps(
+            [AccountRecord("Old", acname, specified_pass)]))
+        with open(fname2, "wb") as file:
+            file.write(token)
+        legacy_file = ezpass.PwFile(fname2, FILE_PASSWORD, True)
+        self.assertEqual(ezpass.AccountDB(legacy_file).orgs(), ["Old"])
+        # rekeying upgrades the file to a header with a random salt
+        legacy_file.rekey()
+        with open(fname2, "rb") as file:
+            self.assertEqual(file.read().startswith(pwfile_module.MAGIC), True)
+        upgraded = ezpass.PwFile(fname2, FILE_PASSWORD, True)
+        self.assertNotEqual(upgraded._kdf["salt"],
+                            pwfile_module.LEGACY_KDF["salt"])
+        self.assertEqual(ezpass.AccountDB(upgraded).orgs(), ["Old"])
+        os.remove(fname2)
+
+    def test_new_files_get_own_salt_and_iterations(self):
+        fname2 = self.get_non_existing_fname()
+        fname3 = fname2 + "3"
+        file2 = ezpass.PwFile.create_new_file(fname2, FILE_PASSWORD, True,
+                                              iterations=120000)
+        file3 = ezpass.PwFile.create_new_file(fname3, FILE_PASSWORD, True)
+        self.assertNotEqual(file2._kdf["salt"], file3._kdf["salt"])
+        self.assertEqual(ezpass.PwFile(fname2, FILE_PASSWORD, True)
+                         .get_iterations(), 120000)
+        self.assertEqual(file3.get_iterations(),
+                         pwfile_module.DEFAULT_ITERATIONS)
+        os.remove(fname2)
+        os.remove(fname3)
+
+    def test_calibrate_iterations(self):
+        iterations = ezpass.PwFile.calibrate_iterations(0.01)
+        self.assertGreaterEqual(iterations, pwfile_module.DEFAULT_ITERATIONS)
+
+    def test_binary_serializer_round_trip(self):
+        records = [AccountRecord("Org", acname, specified_pass),
+                   AccountRecord("B\u00fccher", "\u2603", "p\u00e4ss")]
+        payload = serializer.BinarySerializer.dumps(records)
+        self.assertEqual(payload[:3], serializer.MAGIC)
+        self.assertEqual(serializer.loads(payload), records)
+        for change in [("put", records[1]), ("del", "B\u00fccher")]:
+            data = serializer.BinarySerializer.dumps_change(change)
+            self.assertEqual(serializer.loads_change(data), change)
+        # a field holding the separator is cut at the lengths instead
+        records.append(AccountRecord("Nul", "a\0b", "\0"))
+        self.assertEqual(serializer.loads(
+            serializer.BinarySerializer.dumps(records)), records)
+        # schema version 1 had no separators
+        fields = [field for record in records for field in record]
+        payload = serializer._HEADER.pack(serializer.MAGIC, 1, len(records)) \
+            + struct.pack(">{}I".format(len(fields)), *map(len, fields)) \
+            + "".join(fields).encode()
+        self.assertEqual(serializer.loads(payload), records)
+        self.assertEqual(serializer.loads(
+            serializer.BinarySerializer.dumps([])), [])
+
+    def test_pickle_loading_is_restricted(self):
+        payload = pickle.dumps([os.system])
+        try:
+            serializer.loads(payload)
+            self.fail("Did not raise expected error")
+        except pickle.UnpicklingError as err:
+            pass
+
+    def test_pickled_file_converted_on_write(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, FILE_PASSWORD, True)
+        old = ezpass.PwFile(fname2, FILE_PASSWORD, True,
+                            serializer=serializer.PickleSerializer)
+        old.writeFile([AccountRecord("Org", acname, specified_pass)])
+        pwfile2 = ezpass.PwFile(fname2, FILE_PASSWORD, True)
+        self.assertEqual(pwfile2.legacy_format, True)
+        db = ezpass.AccountDB(pwfile2)
+        self.assertEqual(db.dirty, True)
+        db.flush()
+        pwfile2 = ezpass.PwFile(fname2, FILE_PASSWORD, True)
+        self.assertEqual(pwfile2.legacy_format, False)
+        self.assertEqual(ezpass.AccountDB(pwfile2).orgs(), ["Org"])
+        os.remove(fname2)
+
+    def test_indexed_layout_lookup(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, FILE_PASSWORD, True,
+                                      layout='indexed')
+        db = ezpass.AccountDB(ezpass.PwFile(fname2, FILE_PASSWORD, True))
+        for org in ["One", "Two", "Three"]:
+            ezpass.Account(db, org).create_new_account(acname, test_alphabet, 8)
+        db.set_password("Two", specified_pass)
+        db.flush()
+
+        pwfile2 = ezpass.PwFile(fname2, FILE_PASSWORD, True)
+        self.assertEqual(pwfile2.layout, 'indexed')
+        self.assertEqual(pwfile2.has_index(), True)
+        lazy_db = ezpass.AccountDB(pwfile2, lazy=True)
+        self.assertEqual(lazy_db.find("Two"),
+                         AccountRecord("Two", acname, specified_pass))
+        self.assertIsNone(lazy_db.find("Four"))
+        self.assertEqual([match.org for match in lazy_db.search("tw")],
+                         ["Two"])
+        # only the index and one record were read
+        self.assertIsNone(lazy_db._by_org)
+        self.assertEqual(lazy_db.orgs(), ["One", "Two", "Three"])
+        self.assertEqual(pwfile2.readFile(), db.accounts)
+        os.remove(fname2)
+
+    def test_indexed_layout_journal_without_reading(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, FILE_PASSWORD, True,
+                                      layout='indexed')
+        ezpass.PwFile(fname2, FILE_PASSWORD, True).writeFile(
+            [AccountRecord("One", acname, "p1")])
+        # opened by its index alone, so the file was never hashed
+        pwfile2 = ezpass.PwFile(fname2, FILE_PASSWORD, True, journal=True)
+        pwfile2.appendJournal([('put', AccountRecord("Two", acname, "p2"))])
+        pwfile2.appendJournal([('del', "One")])
+        self.assertEqual(
+            ezpass.PwFile(fname2, FILE_PASSWORD, True).readFile(),
+            [AccountRecord("Two", acname, "p2")])
+        os.remove(fname2)
+        os.remove(fname2 + ".journal")
+
+    def test_indexed_layout_lookup_with_journal(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, FILE_PASSWORD, True,
+                                      layout='indexed')
+        ezpass.PwFile(fname2, FILE_PASSWORD, True).writeFile(
+            [AccountRecord(org, acname, "p")
+             for org in ["One", "Two", "Three"]])
+        db = ezpass.AccountDB(ezpass.PwFile(fname2, FILE_PASSWORD, True,
+                                            journal=True))
+        db.set_password("Two", specified_pass)
+        db.remove("Three")
+        db.add(AccountRecord("Four", acname, "p4"))
+        db.flush()
+        self.assertTrue(os.path.exists(fname2 + ".journal"))
+
+        pwfile2 = ezpass.PwFile(fname2, FILE_PASSWORD, True)
+        stats.enable()
+        stats.reset()
+        self.assertEqual(pwfile2.lookup("Two").acpassword, specified_pass)
+        self.assertEqual(pwfile2.lookup("One").acpassword, "p")
+        self.assertIsNone(pwfile2.lookup("Three"))
+        self.assertEqual(pwfile2.lookup("Four").acpassword, "p4")
+        self.assertEqual(pwfile2.orgs(), ["One", "Two", "Four"])
+        # served from the index and the journal, never the whole file
+        operations = stats.snapshot()["operations"]
+        stats.enable(False)
+        stats.reset()
+        self.assertNotIn("decrypt_file", operations)
+
+        # a journal left behind by an interrupted compaction is ignored
+        with open(fname2 + ".journal", "rb") as journal:
+            contents = journal.read()
+        ezpass.PwFile(fname2, FILE_PASSWORD, True).writeFile(
+            [AccountRecord("One", acname, "p")])
+        with open(fname2 + ".journal", "wb") as journal:
+            journal.write(contents)
+        self.assertIsNone(pwfile2.lookup("Four"))
+        self.assertEqual(pwfile2.orgs(), ["One"])
+        os.remove(fname2)
+        os.remove(fname2 + ".journal")
+
+    def test_indexed_layout_wrong_password(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, FILE_PASSWORD, True,
+                                      layout='indexed')
+        try:
+            ezpass.PwFile(fname2, FILE_PASSWORD + '1', True)
+            self.fail("Did not raise expected exception")
+        except cryptography.fernet.InvalidToken as e:
+            pass
+        os.remove(fname2)
+
+    def test_convert_to_indexed_layout(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, FILE_PASSWORD, True)
+        ezpass.Account(ezpass.PwFile(fname2, FILE_PASSWORD, True),
+                       "One").create_new_account(acname, test_alphabet, 8)
+        single = ezpass.PwFile(fname2, FILE_PASSWORD, True)
+        self.assertEqual(single.has_index(), False)
+        self.assertEqual(single.lookup("One").org, "One")
+        ezpass.PwFile(fname2, FILE_PASSWORD, True, layout='indexed').rekey()
+        indexed = ezpass.PwFile(fname2, FILE_PASSWORD, True)
+        self.assertEqual(indexed.has_index(), True)
+        self.assertEqual(indexed.lookup("One").org, "One")
+        os.remove(fname2)
+
+    def test_chunked_layout(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, FILE_PASSWORD, True,
+                                      layout='chunked')
+        accounts = [AccountRecord("org{}".format(i), acname, specified_pass)
+                    for i in range(20)]
+        chunk_size = pwfile_module.CHUNK_SIZE
+        # small chunks, so that the accounts take several
+        pwfile_module.CHUNK_SIZE = 64
+        try:
+            pwfile2 = ezpass.PwFile(fname2, FILE_PASSWORD, True)
+            pwfile2.writeFile(accounts[:10])
+            with open(fname2, "rb") as enc_file:
+                earlier = enc_file.read().split(b"\n")
+            pwfile2.writeFile(accounts)
+        finally:
+            pwfile_module.CHUNK_SIZE = chunk_size
+        self.assertEqual(ezpass.PwFile(fname2, FILE_PASSWORD, True).readFile(),
+                         accounts)
+        with open(fname2, "rb") as enc_file:
+            lines = enc_file.read().split(b"\n")
+        header, chunks = lines[0], lines[1:-1]
+        self.assertGreater(len(chunks), 3)
+        tampered = [
+            chunks[1:2] + chunks[:1] + chunks[2:],  # reordered
+            chunks[:-1],  # truncated
+            chunks[:1] + earlier[2:3] + chunks[2:],  # from an earlier write
+        ]
+        damaged = bytearray(chunks[2])
+        damaged[40] ^= 1
+        tampered.append(chunks[:2] + [bytes(damaged)] + chunks[3:])
+        # once the password is proven right, damage is not a wrong password
+        for bad_chunks in tampered:
+            with open(fname2, "wb") as enc_file:
+                enc_file.write(b"\n".join([header] + bad_chunks + [b""]))
+            with self.assertRaises(pwfile_module.CorruptFile):
+                ezpass.PwFile(fname2, FILE_PASSWORD, True)
+        # a chunk size no chunk could hold is refused before allocating it
+        huge = header.replace(b'"chunk_size": 64', b'"chunk_size": 1' +
+                              b"0" * 15)
+        self.assertNotEqual(huge, header)
+        with open(fname2, "wb") as enc_file:
+            enc_file.write(b"\n".join([huge] + chunks + [b""]))
+        with self.assertRaises(pwfile_module.CorruptFile):
+            ezpass.PwFile(fname2, FILE_PASSWORD, True)
+        with self.assertRaises(cryptography.fernet.InvalidToken):
+            ezpass.PwFile(fname2, FILE_PASSWORD + "1", True)
+        os.remove(fname2)
+
+    def test_decrypt_mapped_matches_fernet(self):
+        key = bytearray(os.urandom(32))
+        fernet = pwfile_module.PwFile._fernet(key)
+        # empty, around one AES block, and tokens of one and several times
+        # the size files are read in
+        chunk = pwfile_module._CHUNK
+        for size in [0, 1, 15, 16, chunk, 3 * chunk + 7]:
+            plaintext = os.urandom(size)
+            contents = b"header\n" + fernet.encrypt(plaintext)
+            self.assertEqual(pwfile_module.PwFile._decryptMapped(
+                key, contents, len(b"header\n")), plaintext)
+
+        contents = bytearray(fernet.encrypt(os.urandom(chunk)))
+        contents[chunk // 2] ^= 1
+        for damaged in [bytes(contents), fernet.encrypt(b"data")[:-4]]:
+            try:
+                pwfile_module.PwFile._decryptMapped(key, damaged, 0)
+                self.fail("Did not raise expected exception")
+            except cryptography.fernet.InvalidToken as e:
+                pass
+
+    def test_open_unencrypted_file_as_encrypted(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, None, False)
+        old = ezpass.PwFile(fname2, None, False,
+                            serializer=serializer.PickleSerializer)
+        old.writeFile([AccountRecord("Org", acname, specified_pass)])
+        try:
+            ezpass.PwFile(fname2, FILE_PASSWORD, True)
+            self.fail("Did not raise expected exception")
+        except UnicodeDecodeError as e:
+            pass
+        pwfile2 = ezpass.PwFile(fname2, None, False)
+        self.assertEqual(pwfile2.readFile(),
+                         [AccountRecord("Org", acname, specified_pass)])
+        self.assertEqual(pwfile2.legacy_format, True)
+        # the binary format is recognised before any key derivation
+        pwfile2.writeFile(pwfile2.readFile())
+        kdf_count = ezpass.PwFile.kdf_count
+        with self.assertRaises(pwfile_module.NotEncrypted):
+            ezpass.PwFile(fname2, FILE_PASSWORD, True)
+        self.assertEqual(ezpass.PwFile.kdf_count, kdf_count)
+        os.remove(fname2)
+
+    def test_agent_serves_unlocked_file(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, FILE_PASSWORD, True)
+        ezpass.Account(ezpass.PwFile(fname2, FILE_PASSWORD, True),
+                       "Org").create_new_account(acname, test_alphabet, 8)
+        sock_dir = tempfile.mkdtemp()
+        server = agent.AgentServer(os.path.join(sock_dir, "agent"), 60)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        client = agent.AgentClient(server.sock_path)
+        try:
+            self.assertRaises(agent.NotUnlocked, client.find, fname2, "Org")
+            self.assertRaises(RuntimeError, client.add, fname2,
+                              FILE_PASSWORD + '1', True)
+            client.add(fname2, FILE_PASSWORD, True)
+            kdf_before = ezpass.PwFile.kdf_count
+            self.assertEqual(client.find(fname2, "Org").acname, acname)
+            self.assertIsNone(client.find(fname2, "Other"))
+            self.assertEqual(ezpass.PwFile.kdf_count, kdf_before)
+
+            # changes to the file are picked up
+            ezpass.Account(ezpass.PwFile(fname2, FILE_PASSWORD, True),
+                           "Org").set_acpass(specified_pass)
+            self.assertEqual(client.find(fname2, "Org").acpassword,
+                             specified_pass)
+
+            client.lock(fname2)
+            self.assertRaises(agent.NotUnlocked, client.find, fname2, "Org")
+            # files are forgotten once the timeout has passed
+            server.timeout = 0
+            client.add(fname2, FILE_PASSWORD, True)
+            self.assertRaises(agent.NotUnlocked, client.find, fname2, "Org")
+        finally:
+            client.stop()
+            thread.join()
+        self.assertFalse(os.path.exists(server.sock_path))
+        os.rmdir(sock_dir)
+        os.remove(fname2)
+
+    def test_get_falls_back_when_agent_fails(self):
+        sock_dir = tempfile.mkdtemp()
+        sock_path = os.path.join(sock_dir, "agent")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(sock_path)
+        listener.listen()
+        listener.settimeout(5)
+        # an error reply, then no reply at all
+        replies = [b'{"ok": false, "error": "boom"}\n', b""]
+
+        def serve():
+            for reply in replies:
+                try:
+                    conn = listener.accept()[0]
+                except socket.timeout:
+                    return
+                with conn:
+                    conn.recv(4096)
+                    conn.sendall(reply)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        os.environ[agent.SOCKET_ENV] = sock_path
+        try:
+            for reply in replies:
+                self.assertFalse(ezpass.get_from_agent(fname, "Twitter",
+                                                       True))
+        finally:
+            del os.environ[agent.SOCKET_ENV]
+            thread.join()
+            listener.close()
+            os.remove(sock_path)
+            os.rmdir(sock_dir)
+
+    def test_import_defers_modules(self):
+        script = ("import json, sys, ezpass\n"
+                  "print(json.dumps(sorted(sys.modules)))\n")
+        result = subprocess.run([sys.executable, "-c", script],
+                                capture_output=True, text=True, check=True)
+        imported = json.loads(result.stdout)
+        for module in DEFERRED_IMPORTS:
+            self.assertNotIn(module, imported)
+
+    def test_unencrypted_file_does_not_load_cryptography(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, None, False)
+        script = ("import sys, ezpass\n"
+                  "db = ezpass.AccountDB(ezpass.PwFile({!r}, None, False))\n"
+                  "ezpass.Account(db, 'Org').create_new_account('user', "
+                  "ezpass.ALPHABET, 8)\n"
+                  "db.flush()\n"
+                  "print('cryptography' in sys.modules)\n").format(fname2)
+        result = subprocess.run([sys.executable, "-c", script],
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), "False")
+        os.remove(fname2)
+
+    def test_lock_waits_for_other_threads(self):
+        fname2 = self.get_non_existing_fname()
+        pwfile2 = ezpass.PwFile.create_new_file(fname2, None, False)
+        held = threading.Event()
+        release = threading.Event()
+        order = []
+
+        def holder():
+            with pwfile2.lock(exclusive=True):
+                with pwfile2.lock(exclusive=True):
+                    held.set()
+                    release.wait(5)
+                order.append("holder")
+
+        def reader():
+            with pwfile2.lock():
+                order.append("reader")
+
+        threads = [threading.Thread(target=holder),
+                   threading.Thread(target=reader)]
+        threads[0].start()
+        held.wait(5)
+        threads[1].start()
+        threads[1].join(0.2)
+        # the reader doesn't join the holder's lock
+        self.assertEqual(order, [])
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ["holder", "reader"])
+        os.remove(fname2)
+
+    def test_flush_merges_concurrent_changes(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, FILE_PASSWORD, True)
+        ezpass.Account(ezpass.PwFile(fname2, FILE_PASSWORD, True),
+                       "Shared").create_new_account(acname, test_alphabet, 8)
+        # two sessions read the same file, then both change it
+        db1 = ezpass.AccountDB(ezpass.PwFile(fname2, FILE_PASSWORD, True))
+        db2 = ezpass.AccountDB(ezpass.PwFile(fname2, FILE_PASSWORD, True,
+                                             journal=True))
+        generation = db1.pwfile.generation
+        ezpass.Account(db1, "One").create_new_account(acname, test_alphabet, 8)
+        db1.remove("Shared")
+        db1.flush()
+        self.assertEqual(db1.pwfile.generation, generation + 1)
+        self.assertEqual(db2.pwfile.is_stale(), True)
+        ezpass.Account(db2, "Two").create_new_account(acname, test_alphabet, 8)
+        db2.flush()
+        self.assertEqual(db2.orgs(), ["One", "Two"])
+        self.assertEqual(db1.pwfile.is_stale(), True)
+        self.assertEqual(db2.pwfile.is_stale(), False)
+        pwfile2 = ezpass.PwFile(fname2, FILE_PASSWORD, True)
+        self.assertEqual(ezpass.AccountDB(pwfile2).orgs(), ["One", "Two"])
+        os.remove(fname2)
+        os.remove(pwfile2.get_journal_fname())
+
+    def test_unencrypted_file_staleness(self):
+        fname2 = self.get_non_existing_fname()
+        ezpass.PwFile.create_new_file(fname2, None, False)
+        db1 = ezpass.AccountDB(ezpass.PwFile(fname2, None, False))
+        db2 = ezpass.AccountDB(ezpass.PwFile(fname2, None, False))
+        self.assertEqual(db1.pwfile.generation, None)
+        ezpass.Account(db1, "One").create_new_account(acname, test_alphabet, 8)
+        db1.flush()
+        self.assertEqual(db2.pwfile.is_stale(), True)
+        ezpass.Account(db2, "Two").create_new_account(acname, test_alphabet, 8)
+        db2.flush()
+        self.assertEqual(ezpass.AccountDB(ezpass.PwFile(fname2, None, False))
+                         .orgs(), ["One", "Two"])
+        os.remove(fname2)
+
+    def test_parallel_writers_lose_no_updates(self):
+        writers = 200
+        fname2 = self.get_non_existing_fname()
+        # a cheap key derivation keeps hundreds of processes quick
+        ezpass.PwFile.create_new_file(fname2, FILE_PASSWORD, True,
+                                      iterations=1000)
+        ezpass.Account(ezpass.PwFile(fname2, FILE_PASSWORD, True),
+                       "Shared").create_new_account(acname, test_alphabet, 8)
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=_parallel_writer, args=(fname2, i))
+                     for i in range(writers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        db = ezpass.AccountDB(ezpass.PwFile(fname2, FILE_PASSWORD, True))
+        self.assertEqual(sorted(db.orgs()), sorted(
+            ["Shared"] + ["org{}".format(i) for i in range(writers)]))
+        self.assertIn(db.find("Shared").acpassword,
+                      ["pass{}".format(i) for i in range(writers)])
+        for suffix in ["", ".journal"]:
+            if os.path.exists(fname2 + suffix):
+                os.remove(fname2 + suffix)
+
     def test_create_new_file_existing(self):
         fname = "test_file.csv"
         try:
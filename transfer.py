@@ -0,0 +1,195 @@
+"""
+Bulk import & export of accounts between an AccountDB session and CSV or
+JSON-lines files. Rows are streamed one at a time in both directions.
+
+CSV files have a header row with the columns org, username and password.
+JSON-lines files hold one object per line with the same keys.
+
+format_credentials writes a few accounts in the formats deploy scripts read
+credentials in (see CREDENTIAL_FORMATS).
+"""
+import csv
+import json
+import os
+import re
+import shlex
+
+from accountdb import AccountDB, AccountRecord
+from account import Account
+
+FORMATS = ['csv', 'jsonl']
+FIELDS = ['org', 'username', 'password']
+# export: shell lines 'export ORG_USERNAME=...' and 'export ORG_PASSWORD=...'
+# netrc: a .netrc 'machine' entry per org
+# json: an object mapping each org to its username and password
+CREDENTIAL_FORMATS = ['export', 'netrc', 'json']
+
+
+def guess_format(fname: str) -> str:
+    """
+    :param fname: name of import/export file
+    :return: 'csv' or 'jsonl', based on the file extension
+    """
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == '.csv':
+        return 'csv'
+    if ext in ('.jsonl', '.json', '.ndjson'):
+        return 'jsonl'
+    raise RuntimeError("Can't tell format of '{}'. Use one of: {}".format(
+        fname, ", ".join(FORMATS)))
+
+
+def _read_rows(file, fmt: str):
+    """
+    Yields (line number, row dict) for each row of an open import file
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_num, line in enumerate(file, 1):
+            if line.strip() == "":
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                row = e
+            yield line_num, row
+
+
+def _check_row(row, seen: dict, db: AccountDB):
+    """
+    :return: reason why row can't be imported, or None if it is valid
+    """
+    if isinstance(row, Exception):
+        return "invalid JSON: {}".format(row)
+    if not isinstance(row, dict):
+        return "row is not an object"
+    for field in FIELDS:
+        value = row.get(field)
+        if not isinstance(value, str) or not Account._validate_string(value):
+            return "invalid {}".format(field)
+    org = row['org']
+    if db.has(org) or org in seen:
+        return "account for org '{}' already exists".format(org)
+    return None
+
+
+def import_records(db: AccountDB, fname: str, fmt: str = None) -> tuple:
+    """
+    Streams accounts from fname into the session. Valid rows are added;
+    invalid rows are skipped and reported
+    :param db: AccountDB session
+    :param fname: name of CSV or JSON-lines file to import
+    :param fmt: 'csv' or 'jsonl'; guessed from fname if None
+    :return: tuple of (number of accounts imported, list of (line number,
+    reason) for rows that were rejected)
+    """
+    if fmt is None:
+        fmt = guess_format(fname)
+    seen = {}
+    invalid = []
+    with open(fname, newline='') as file:
+        for line_num, row in _read_rows(file, fmt):
+            reason = _check_row(row, seen, db)
+            if reason is not None:
+                invalid.append((line_num, reason))
+                continue
+            seen[row['org']] = AccountRecord(
+                row['org'], row['username'], row['password'])
+    for record in seen.values():
+        db.add(record)
+    return len(seen), invalid
+
+
+def export_records(db: AccountDB, fname: str, fmt: str = None) -> int:
+    """
+    Streams every account in the session to a new file fname. The file holds
+    plaintext passwords, so it is created readable by the owner only
+    :param db: AccountDB session
+    :param fname: name of CSV or JSON-lines file to create
+    :param fmt: 'csv' or 'jsonl'; guessed from fname if None
+    :return: number of accounts exported
+    :side effect: new file fname
+    """
+    if fmt is None:
+        fmt = guess_format(fname)
+    if os.path.isfile(fname):
+        raise RuntimeError("File '{}' already exists".format(fname))
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    count = 0
+    with open(fd, 'w', newline='') as file:
+        if fmt == 'csv':
+            writer = csv.writer(file)
+            writer.writerow(FIELDS)
+        for account in db:
+            row = [account.org, account.acname, account.acpassword]
+            if fmt == 'csv':
+                writer.writerow(row)
+            else:
+                file.write(json.dumps(dict(zip(FIELDS, row))) + "\n")
+            count += 1
+    return count
+
+
+def env_name(org: str) -> str:
+    """
+    :param org: name of organization
+    :return: org as the start of an environment variable name, e.g. 'AWS_PROD'
+    for 'aws-prod'
+    """
+    name = re.sub(r'[^A-Z0-9]', '_', org.upper())
+    if name[0].isdigit():
+        name = '_' + name
+    return name
+
+
+def _netrc_token(value: str) -> str:
+    """
+    :param value: org, username or password (no line breaks)
+    :return: value as a .netrc token: in double quotes, with '"' and '\\'
+    escaped by a backslash, if it holds whitespace (account fields may hold
+    tabs), either of those or starts with '#'
+    """
+    if re.search(r'[\s"\\]', value) is None and not value.startswith('#'):
+        return value
+    return '"' + re.sub(r'(["\\])', r'\\\1', value) + '"'
+
+
+def format_credentials(accounts: list, fmt: str) -> str:
+    """
+    :param accounts: list of AccountRecord
+    :param fmt: one of CREDENTIAL_FORMATS
+    :return: the accounts' usernames and passwords in format fmt
+    """
+    if fmt == 'json':
+        return json.dumps({account.org: {"username": account.acname,
+                                         "password": account.acpassword}
+                           for account in accounts}, indent=2) + "\n"
+    lines = []
+    if fmt == 'netrc':
+        unwritable = [account.org for account in accounts
+                      if re.search(r'[\r\n]', account.org + account.acname +
+                                   account.acpassword)]
+        if unwritable:
+            raise RuntimeError("Can't write accounts with line breaks to "
+                               ".netrc: {}".format(" ".join(unwritable)))
+        for account in accounts:
+            lines.append("machine {}\n  login {}\n  password {}".format(
+                _netrc_token(account.org), _netrc_token(account.acname),
+                _netrc_token(account.acpassword)))
+        return "\n".join(lines) + "\n"
+    names = {}
+    for account in accounts:
+        name = env_name(account.org)
+        if name in names:
+            raise RuntimeError("Orgs '{}' and '{}' have the same variable "
+                               "name {}".format(names[name], account.org,
+                                                name))
+        names[name] = account.org
+        lines.append("export {}_USERNAME={}".format(
+            name, shlex.quote(account.acname)))
+        lines.append("export {}_PASSWORD={}".format(
+            name, shlex.quote(account.acpassword)))
+    return "\n".join(lines) + "\n"
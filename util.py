@@ -2,7 +2,8 @@
 Password generation utilities for ezpass
 """
 
-import random
+import functools
+import secrets
 
 ALPHABET = 'abcdefghijklmnopqrstuvwxyz'
 
@@ -13,9 +14,7 @@ def generate_random_letter(alphabet: str) -> str:
     :param alphabet: string representing full alphabet
     :return: one random letter from the alphabet
     """
-    index = random.randint(0, len(alphabet) - 1)
-    letter = alphabet[index]
-    return letter
+    return secrets.choice(alphabet)
 
 
 def create_password(alphabet: str, length: int) -> str:
@@ -26,8 +25,50 @@ def create_password(alphabet: str, length: int) -> str:
     :return: a password of specified length using letters from ALPHABET
     """
     assert (length > 0)
-    password = ""
-    for i in range(length):
-        letter = generate_random_letter(alphabet)
-        password = password + letter
-    return password
+    return create_passwords(alphabet, length, 1)[0]
+
+
+def create_passwords(alphabet: str, length: int, count: int) -> list:
+    """
+    Creates count passwords of specified length using letters from ALPHABET.
+    Random bytes are drawn from the OS CSPRNG in blocks and mapped onto the
+    alphabet; bytes that would make some letters more likely than others
+    (modulo bias) are rejected.
+    :param alphabet: string representing full alphabet
+    :param length: length of each password - an integer > 0
+    :param count: number of passwords - an integer > 0
+    :return: list of count passwords
+    """
+    assert (length > 0)
+    assert (count > 0)
+    needed = length * count
+    if len(alphabet) > 256 or max(alphabet) > '\xff':
+        # letters don't fit in a byte, so draw them one at a time
+        letters = ''.join(secrets.choice(alphabet) for i in range(needed))
+    else:
+        table, rejected, limit = _byte_table(alphabet)
+        chunks = []
+        found = 0
+        while found < needed:
+            # draw enough for the expected number of rejections, plus slack
+            block = (needed - found) * 256 // limit + 16
+            chunk = secrets.token_bytes(block).translate(table, rejected)
+            chunks.append(chunk)
+            found += len(chunk)
+        letters = b''.join(chunks)[:needed].decode('latin-1')
+    return [letters[i:i + length] for i in range(0, needed, length)]
+
+
+@functools.lru_cache(maxsize=16)
+def _byte_table(alphabet: str) -> tuple:
+    """
+    :param alphabet: string of at most 256 letters that each fit in a byte
+    :return: tuple of (bytes.translate table mapping a random byte onto the
+    alphabet, byte values to reject, number of accepted byte values)
+    """
+    size = len(alphabet)
+    # byte values >= limit are rejected so every letter is equally likely
+    limit = 256 - 256 % size
+    table = bytes(ord(alphabet[i % size]) for i in range(256))
+    rejected = bytes(range(limit, 256))
+    return table, rejected, limit
@@ -0,0 +1,106 @@
+"""
+Opens several password files (vaults) at once, e.g. one per environment, and
+looks accounts up across all of them.
+
+The files are unlocked on a thread pool. Most of the time taken to open an
+encrypted file goes to key derivation (PBKDF2) and decryption, which run in
+OpenSSL with the GIL released, so unlocking several files takes about as long
+as unlocking the slowest of them when there are enough CPU cores.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from pwfile import PwFile
+from accountdb import AccountDB
+from search import KINDS
+
+
+def unlock(fnames: list, passwords: list, encrypt: bool, **options) -> tuple:
+    """
+    Opens all files in parallel
+    :param fnames: list of file names
+    :param passwords: list of the password of each file (None if not
+    encrypted)
+    :param encrypt: whether or not the files are encrypted (bool)
+    :param options: other PwFile arguments, used for every file
+    :return: tuple of (dict of file name -> PwFile for the files that opened,
+    dict of file name -> exception raised opening each of the others)
+    """
+    def open_file(fname, password):
+        try:
+            return PwFile(fname, password, encrypt, **options), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=max(len(fnames), 1)) as pool:
+        results = list(pool.map(open_file, fnames, passwords))
+    pwfiles = {}
+    errors = {}
+    for fname, (pwfile, error) in zip(fnames, results):
+        if error is None:
+            pwfiles[fname] = pwfile
+        else:
+            errors[fname] = error
+    return pwfiles, errors
+
+
+class Vaults:
+    '''
+    Read-only session over several PwFiles. Results are labelled with the
+    name of the file they come from and listed in the order the files were
+    given in.
+    '''
+
+    def __init__(self, pwfiles: list) -> None:
+        """
+        :param pwfiles: list of PwFile instances
+        """
+        # nothing is decrypted until a lookup or search needs it, so -g on
+        # several indexed files decrypts one record (plus the index) in each
+        self.dbs = [AccountDB(pwfile, lazy=True) for pwfile in pwfiles]
+
+    def sources(self) -> list:
+        return [db.pwfile.get_fname() for db in self.dbs]
+
+    def _map(self, func) -> list:
+        """
+        Calls func on every file's AccountDB, in parallel; each AccountDB is
+        only used by one thread
+        :return: list of (file name, result) tuples, in file order
+        """
+        if len(self.dbs) == 1:
+            results = [func(self.dbs[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(self.dbs)) as pool:
+                results = list(pool.map(func, self.dbs))
+        return list(zip(self.sources(), results))
+
+    def find(self, org: str, ignore_case: bool = False) -> list:
+        """
+        :param org: name of organization
+        :param ignore_case: see AccountDB.find
+        :return: list of (file name, AccountRecord) tuples, one for each file
+        that holds an account for org
+        """
+        found = self._map(lambda db: db.find(org, ignore_case))
+        return [(source, account) for source, account in found
+                if account is not None]
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """
+        Searches the orgs of every file (see AccountDB.search)
+        :param query: part or misspelling of an org name
+        :param limit: most matches to return; 0 or None for all
+        :return: list of (file name, search.Match) tuples, best first
+        """
+        found = self._map(lambda db: db.search(query, limit))
+        matches = [(source, match) for source, file_matches in found
+                   for match in file_matches]
+        # sort is stable, so equally good matches stay in file order
+        matches.sort(key=lambda item: (KINDS.index(item[1].kind),
+                                       -item[1].score))
+        return matches[:limit] if limit else matches
+
+    def zeroize(self) -> None:
+        for db in self.dbs:
+            db.pwfile.zeroize()
+        return